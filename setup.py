@@ -8,6 +8,7 @@ TESTS_REQUIRE = [
     'ExtensionClass',
     'fudge',
     'nti.testing',
+    'numpy',
     'zope.testrunner',
 ]
 
@@ -57,6 +58,7 @@ setup(
         'nti.zodb',
         'persistent',
         'repoze.lru',
+        'transaction',
         'zc.queue',
         'ZODB',
         'zope.annotation',
@@ -73,6 +75,9 @@ setup(
     ],
     extras_require={
         'test': TESTS_REQUIRE,
+        'arrays': [
+            'numpy',
+        ],
         'docs': [
             'Sphinx',
             'repoze.sphinx.autointerface',
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Exporting the intid sets of an
+:class:`nti.containers.datastructures.IntidContainedStorage` as
+:mod:`numpy` arrays for vectorized analysis.
+
+This module requires :mod:`numpy`; install the ``arrays`` extra.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class IntidMembershipMatrix(object):
+    """
+    A container by intid membership matrix in compressed sparse row
+    (CSR) form. Row *i* describes the container ``containerIds[i]``; its
+    (sorted) intids are ``indices[indptr[i]:indptr[i + 1]]``.
+    """
+
+    def __init__(self, containerIds, indptr, indices):
+        #: The containerId for each row.
+        self.containerIds = containerIds
+        #: int64 array of row boundaries, one longer than the rows.
+        self.indptr = indptr
+        #: int64 array of the intids of all the rows, concatenated.
+        self.indices = indices
+        self._rows = {containerId: i for i, containerId in enumerate(containerIds)}
+
+    def __len__(self):
+        return len(self.containerIds)
+
+    def row(self, containerId):
+        """
+        The intids of the given container, as an int64 array.
+        """
+        i = self._rows[containerId]
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def sizes(self):
+        """
+        An int64 array of the number of intids in each container.
+        """
+        return numpy.diff(self.indptr)
+
+    def intersection_count(self, containerId, otherContainerId):
+        """
+        The number of intids the two containers have in common.
+        """
+        common = numpy.intersect1d(self.row(containerId),
+                                   self.row(otherContainerId),
+                                   assume_unique=True)
+        return len(common)
+
+    def intersection_counts(self, chunk_size=1 << 20):
+        """
+        The number of intids each pair of containers has in common,
+        as a square int64 array (whose diagonal is :meth:`sizes`).
+
+        The result is dense, so it alone takes ``8 * rows * rows``
+        bytes. Computing it is a sparse co-occurrence count: the work
+        done is proportional to the number of (container, container)
+        pairs sharing an intid, not to the size of the membership
+        matrix. Beyond the result, at most *chunk_size* pairs are
+        buffered before their counts are added to it.
+        """
+        rows = len(self)
+        sizes = self.sizes()
+        result = numpy.zeros((rows, rows), dtype=numpy.int64)
+        result[numpy.diag_indices(rows)] = sizes
+        if not len(self.indices):
+            return result
+        # Group the (intid, row) pairs by intid. The sort is stable,
+        # so within a group the rows are ascending.
+        row_of = numpy.repeat(numpy.arange(rows, dtype=numpy.int64), sizes)
+        order = numpy.argsort(self.indices, kind='mergesort')
+        intids = self.indices[order]
+        row_of = row_of[order]
+        group_starts = numpy.flatnonzero(numpy.r_[True, intids[1:] != intids[:-1]])
+        group_sizes = numpy.diff(numpy.r_[group_starts, len(intids)])
+        # How many members of its group follow each entry
+        following = numpy.repeat(group_starts + group_sizes, group_sizes) \
+                  - numpy.arange(len(intids)) - 1
+
+        def flush(pending):
+            # Each key is row * rows + column, with row < column
+            keys, counts = numpy.unique(numpy.concatenate(pending),
+                                        return_counts=True)
+            upper, lower = numpy.divmod(keys, rows)
+            numpy.add.at(result, (upper, lower), counts)
+            numpy.add.at(result, (lower, upper), counts)
+
+        pending = []
+        pending_count = 0
+        candidates = numpy.flatnonzero(following)
+        distance = 1
+        while len(candidates):
+            keys = row_of[candidates] * rows + row_of[candidates + distance]
+            pending.append(keys)
+            pending_count += len(keys)
+            if pending_count >= chunk_size:
+                flush(pending)
+                pending = []
+                pending_count = 0
+            distance += 1
+            candidates = candidates[following[candidates] >= distance]
+        if pending:
+            flush(pending)
+        return result
+
+
+def _intid_array(container_set):
+    if isinstance(container_set, tuple):
+        return numpy.array(container_set, dtype=numpy.int64)
+    # Iterating the set directly walks its buckets in C. We don't
+    # pass the maintained length as ``count``: if it has drifted, the
+    # row would be silently truncated.
+    return numpy.fromiter(container_set, dtype=numpy.int64)
+
+
+def export_intids(storage, containerIds=None):
+    """
+    Export the given containers of *storage* (by default, all of
+    them) as an :class:`IntidMembershipMatrix`. Unknown containers are
+    exported as empty rows.
+    """
+    # pylint: disable=protected-access
+    if containerIds is None:
+        containerIds = list(storage)
+    else:
+        containerIds = list(containerIds)
+    arrays = []
+    for containerId in containerIds:
+        container_set = storage._lookup_container(containerId)
+        if container_set is None:
+            arrays.append(numpy.zeros(0, dtype=numpy.int64))
+        else:
+            arrays.append(_intid_array(container_set))
+    indptr = numpy.zeros(len(arrays) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(x) for x in arrays], out=indptr[1:])
+    if arrays:
+        indices = numpy.concatenate(arrays)
+    else:
+        indices = numpy.zeros(0, dtype=numpy.int64)
+    return IntidMembershipMatrix(containerIds, indptr, indices)
@@ -12,11 +12,13 @@ import six
 
 from zope import interface
 
+from zope.interface.declarations import ProvidesClass
+
 from zope.container.contained import fixing_up
 from zope.container.contained import _SENTINEL
 
+from zope.container.contained import containedEvent
 from zope.container.contained import ContainedProxy
-from zope.container.contained import notifyContainerModified
 
 from zope.event import notify
 
@@ -26,12 +28,20 @@ from zope.lifecycleevent import ObjectRemovedEvent
 from zope.location.interfaces import ILocation
 from zope.location.interfaces import IContained
 
-logger = __import__('logging').getLogger(__name__)
+from nti.containers.interfaces import ContainerContentsChangedEvent
 
+logger = __import__('logging').getLogger(__name__)
 
 def noOwnershipContainedEvent(obj, container, name=None):
     """
     see zope.container.contained.containedEvent
+
+    An :class:`ILocation` that doesn't already provide
+    :class:`IContained` is declared to provide it, which changes the
+    object and stores the declaration in its pickle. To avoid that,
+    declare ``IContained`` on the class when it's defined or
+    configured (with ``@implementer`` or a ZCML ``<implements>``), and
+    see :func:`remove_contained_declarations` for existing objects.
     """
 
     if not IContained.providedBy(obj):
@@ -54,10 +64,7 @@ def noOwnershipContainedEvent(obj, container, name=None):
     return obj, event
 
 
-def no_ownership_setitem(container, setitemf, name, obj):
-    """
-    see zope.container.contained.setitem
-    """
+def _checkName(name):
     # Do basic name check:
     if isinstance(name, bytes):
         try:
@@ -69,7 +76,22 @@ def no_ownership_setitem(container, setitemf, name, obj):
 
     if not name:
         raise ValueError("empty names are not allowed")
+    return name
 
+
+def no_ownership_setitem(container, setitemf, name, obj, insertitemf=None):
+    """
+    see zope.container.contained.setitem
+
+    If *insertitemf* is given, it's used instead of *setitemf*. It
+    must store the object only if the name is new, returning whether
+    it did (like :meth:`BTrees.OOBTree.OOBTree.insert`), so that
+    adding a new name looks it up just once.
+    """
+    name = _checkName(name)
+    if insertitemf is not None:
+        _no_ownership_insertitem(container, insertitemf, name, obj)
+        return
     old = container.get(name, _SENTINEL)
     if old is obj:
         return
@@ -80,11 +102,97 @@ def no_ownership_setitem(container, setitemf, name, obj):
     setitemf(name, obj)
     if event is not None:
         notify(event)
-        notifyContainerModified(container)
+        notifyContainerContentsChanged(container, added=(name,))
+
+
+def _no_ownership_insertitem(container, insertitemf, name, obj):
+    stored = obj
+    if not IContained.providedBy(obj) and not ILocation.providedBy(obj):
+        stored = ContainedProxy(obj)
+    if not insertitemf(name, stored):
+        if container.get(name, _SENTINEL) is obj:
+            return
+        raise KeyError(name)
+    # Now that it's stored, declare it contained and name it
+    _, event = noOwnershipContainedEvent(stored, container, name)
+    if event is not None:
+        notify(event)
+        notifyContainerContentsChanged(container, added=(name,))
+
+
+def _checkItems(container, pairs):
+    # Check all the names up front; return the items to store
+    if getattr(pairs, 'items', None) is not None:
+        pairs = pairs.items()
+    todo = {}
+    for name, obj in pairs:
+        name = _checkName(name)
+        if todo.get(name, obj) is not obj:
+            raise KeyError(name)
+        old = container.get(name, _SENTINEL)
+        if old is obj:
+            continue
+        if old is not _SENTINEL:
+            raise KeyError(name)
+        todo[name] = obj
+    return todo
+
+
+def _setitems(container, setitemf, pairs, events, contained_event):
+    todo = _checkItems(container, pairs)
+    added = []
+    for name in sorted(todo):
+        obj, event = contained_event(todo[name], container, name)
+        setitemf(name, obj)
+        if event is not None:
+            added.append(event)
+    if events:
+        for event in added:
+            notify(event)
+    if added:
+        notifyContainerContentsChanged(container,
+                                       added=[event.newName for event in added])
+    return len(todo)
+
+
+def no_ownership_setitems(container, setitemf, pairs, events=True):
+    """
+    Like :func:`no_ownership_setitem`, but for many items at once.
+
+    *pairs* is a mapping or an iterable of (name, obj) pairs. All the
+    names are checked before anything is stored, so a bad name or a
+    duplicate leaves the container unchanged. The items are then
+    stored in sorted name order (keeping BTree bucket access
+    sequential) and one
+    :class:`~nti.containers.interfaces.IContainerContentsChangedEvent`
+    is sent. The per-object added events are sent only if *events*
+    is true.
+
+    Returns the number of items stored.
+    """
+    return _setitems(container, setitemf, pairs, events,
+                     noOwnershipContainedEvent)
 
 
-def no_ownership_uncontained(obj, container, unused_name=None):
-    """    
+def setitems(container, setitemf, pairs, events=True):
+    """
+    Like :func:`no_ownership_setitems`, but the container takes
+    ownership of the objects, as with
+    :func:`zope.container.contained.setitem`.
+    """
+    return _setitems(container, setitemf, pairs, events, containedEvent)
+
+
+def notifyContainerContentsChanged(container, added=(), removed=(), modified=()):
+    """
+    Send an :class:`~nti.containers.interfaces.IContainerContentsChangedEvent`
+    for *container* with the given names.
+    """
+    notify(ContainerContentsChangedEvent(container, added, removed, modified))
+
+
+def no_ownership_uncontained(obj, container, name=None):
+    """
     see zope.container.contained.uncontained
     """
     try:
@@ -105,4 +213,42 @@ def no_ownership_uncontained(obj, container, unused_name=None):
 
     event = ObjectRemovedEvent(obj, oldparent, oldname)
     notify(event)
-    notifyContainerModified(container)
+    notifyContainerContentsChanged(container, removed=(name or oldname,))
+
+
+def remove_contained_declarations(objects):
+    """
+    A migration for objects given their own :class:`IContained`
+    declaration by :func:`noOwnershipContainedEvent` before their
+    class declared it: for each of *objects* that directly provides
+    ``IContained`` and whose class implements it, remove it from the
+    object, deleting the object's declaration entirely if nothing
+    else is left in it.
+
+    The class must declare ``IContained`` statically (when it's
+    defined or configured), so that loading the objects in any
+    process finds it. Objects whose class doesn't implement
+    ``IContained`` are left alone.
+
+    Returns the number of objects changed.
+    """
+    count = 0
+    for obj in objects:
+        if not IContained.implementedBy(obj.__class__):
+            continue
+        provides = getattr(obj, '__provides__', None)
+        if not isinstance(provides, ProvidesClass):
+            continue
+        # Once the class implements IContained, directlyProvidedBy()
+        # leaves it out, so use what the declaration was made with
+        # (what's in the pickle)
+        provided = list(provides.__reduce__()[1][1:])
+        if IContained not in provided:
+            continue
+        provided.remove(IContained)
+        if provided:
+            interface.directlyProvides(obj, *provided)
+        else:
+            del obj.__provides__
+        count += 1
+    return count
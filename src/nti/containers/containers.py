@@ -23,6 +23,8 @@ from collections import Mapping
 
 from repoze.lru import lru_cache
 
+import transaction
+
 from slugify import slugify_url
 
 from Acquisition import aq_base
@@ -56,7 +58,10 @@ from ZODB.interfaces import IBroken
 
 from nti.base._compat import text_
 
+from nti.containers.contained import setitems
 from nti.containers.contained import no_ownership_setitem
+from nti.containers.contained import no_ownership_setitems
+from nti.containers.contained import notifyContainerContentsChanged
 from nti.containers.contained import no_ownership_uncontained
 
 from nti.dublincore.time_mixins import DCTimesLastModifiedMixin
@@ -260,13 +265,82 @@ class _CheckObjectOnSetMixin(object):
         checkObject(self, key, value)
         super(_CheckObjectOnSetMixin, self)._setitemf(key, value)
 
+    def _insertitemf(self, key, value):
+        checkObject(self, key, value)
+        return super(_CheckObjectOnSetMixin, self)._insertitemf(key, value)
+
+
+class _AcquiringValues(object):
+    """
+    A lazy view of a sequence of children that acquisition wraps each
+    one as it's read. Like the sequence (typically the
+    ``BTreeItems`` of a BTree container), it can be sized, indexed,
+    sliced and iterated more than once.
+    """
+
+    __slots__ = ('_seq', '_acquire')
+
+    def __init__(self, seq, acquire):
+        self._seq = seq
+        self._acquire = acquire
+
+    def _wrap(self, value):
+        return self._acquire(value)
+
+    def __len__(self):
+        return len(self._seq)
+
+    def __bool__(self):
+        return bool(self._seq)
+    __nonzero__ = __bool__
+
+    def __getitem__(self, index):
+        result = self._seq[index]
+        if isinstance(index, slice):
+            return type(self)(result, self._acquire)
+        return self._wrap(result)
+
+    def __iter__(self):
+        wrap = self._wrap
+        return (wrap(v) for v in self._seq)
+
+
+class _AcquiringItems(_AcquiringValues):
+    """
+    Like :class:`_AcquiringValues`, but for ``(key, child)`` pairs.
+    """
+
+    __slots__ = ()
+
+    def _wrap(self, item):
+        return item[0], self._acquire(item[1])
+
 
 class AcquireObjectsOnReadMixin(object):
     """
     Mix this in /before/ the container to support implicit
     acquisition.
+
+    Objects read with :meth:`__getitem__` and :meth:`get`, and those
+    produced by :meth:`values`, :meth:`items`, :meth:`itervalues` and
+    :meth:`iteritems`, are acquisition wrapped. Those methods return
+    lazy views that wrap each object as it's read; they can be sized,
+    indexed and iterated again just like the container's own.
     """
 
+    #: If true, the wrappers made by :meth:`__getitem__` and
+    #: :meth:`get` are remembered for the rest of the transaction (in
+    #: a volatile attribute), so reading the same child again returns
+    #: the same wrapper. Iterating reuses those wrappers but doesn't
+    #: add to them, so that iterating a large container doesn't keep
+    #: every child in memory. Finding the current transaction costs
+    #: about as much as making a plain :class:`Acquisition.Implicit`
+    #: wrapper, so this is worthwhile when wrapping is expensive or
+    #: callers depend on getting the same wrapper.
+    reuse_acquired_wrappers = False
+
+    _v_acquired_wrappers = None
+
     def __setitem__(self, key, value):
         """
         Ensure that we do not put an acquisition wrapper
@@ -275,12 +349,60 @@ class AcquireObjectsOnReadMixin(object):
         self = aq_base(self)
         super(AcquireObjectsOnReadMixin, self).__setitem__(key, value)
 
+    def _acquisition_parent(self):
+        # Make children __of__ this object. But if this object is
+        # itself already acquired, and from its own parent, then
+        # there's no good reason to acquire from the wrapper that is
+        # this object.
+        base_self = aq_base(self)
+        base_self_parent = getattr(base_self, '__parent__', None)
+        if     base_self is self \
+            or base_self_parent is getattr(self, '__parent__', None):
+            return base_self
+        return self
+
+    def _acquired_wrappers(self, parent):
+        # The wrappers of children of *parent* (if it's the unwrapped
+        # self) made in this transaction, by id of the child. The
+        # wrappers keep the children alive, so the ids are unique.
+        if parent is not aq_base(self):
+            return None
+        jar = getattr(parent, '_p_jar', None)
+        manager = getattr(jar, 'transaction_manager', None) or transaction.manager
+        txn = manager.get()
+        cached = parent._v_acquired_wrappers
+        if cached is None or cached[0] is not txn:
+            cached = parent._v_acquired_wrappers = (txn, {})
+        return cached[1]
+
+    def _acquirer(self, remember=True):
+        """
+        Return a function that acquisition wraps a child of this
+        object. The parent to wrap in is computed only once.
+        """
+        parent = self._acquisition_parent()
+        wrappers = None
+        if self.reuse_acquired_wrappers:
+            wrappers = self._acquired_wrappers(parent)
+
+        def acquire(result):
+            if not IAcquirer.providedBy(result):
+                return result
+            if wrappers is None:
+                return result.__of__(parent)
+            wrapper = wrappers.get(id(result))
+            if wrapper is None:
+                wrapper = result.__of__(parent)
+                if remember:
+                    wrappers[id(result)] = wrapper
+            return wrapper
+        return acquire
+
     def _acquire(self, result):
         if IAcquirer.providedBy(result):
-            # Make it __of__ this object. But if this object is itself
-            # already acquired, and from its own parent, then
-            # there's no good reason to acquire from the wrapper
-            # that is this object.
+            if self.reuse_acquired_wrappers:
+                return self._acquirer()(result)
+            # Inlined _acquisition_parent; this is the hot path
             base_self = aq_base(self)
             base_self_parent = getattr(base_self, '__parent__', None)
             if     base_self is self \
@@ -288,7 +410,6 @@ class AcquireObjectsOnReadMixin(object):
                 result = result.__of__(base_self)
             else:
                 result = result.__of__(self)
-
         return result
 
     def __getitem__(self, key):
@@ -302,6 +423,30 @@ class AcquireObjectsOnReadMixin(object):
             result = self._acquire(result)
         return result
 
+    def values(self, key=None):
+        values = super(AcquireObjectsOnReadMixin, self).values(key)
+        return _AcquiringValues(values, self._acquirer(remember=False))
+
+    def items(self, key=None):
+        items = super(AcquireObjectsOnReadMixin, self).items(key)
+        return _AcquiringItems(items, self._acquirer(remember=False))
+
+    def itervalues(self, min=None, max=None, excludemin=False, excludemax=False):
+        if max is None or min is None:
+            return self.values(min)
+        values = super(AcquireObjectsOnReadMixin, self).itervalues(min, max,
+                                                                   excludemin,
+                                                                   excludemax)
+        return _AcquiringValues(values, self._acquirer(remember=False))
+
+    def iteritems(self, min=None, max=None, excludemin=False, excludemax=False):
+        if max is None or min is None:
+            return self.items(min)
+        items = super(AcquireObjectsOnReadMixin, self).iteritems(min, max,
+                                                                 excludemin,
+                                                                 excludemax)
+        return _AcquiringItems(items, self._acquirer(remember=False))
+
 
 # Last modified based containers
 
@@ -347,14 +492,88 @@ class LastModifiedBTreeContainer(DCTimesLastModifiedMixin,
             self.lastModified = t
         return self.lastModified
 
+    #: If true, adding and removing items sends one
+    #: :class:`~nti.containers.interfaces.IContainerContentsChangedEvent`
+    #: per operation (such as :meth:`setitems`, :meth:`delitems` or
+    #: :meth:`clear`) instead of an added or removed event for each
+    #: object and a container modified event.
+    aggregate_events = False
+
+    def __setitem__(self, key, value):
+        if self.aggregate_events:
+            setitems(self, self._setitemf, ((key, value),), False)
+        else:
+            super(LastModifiedBTreeContainer, self).__setitem__(key, value)
+
+    def setitems(self, items):
+        """
+        Store each of the (key, value) pairs in *items* (or a mapping)
+        with :func:`~nti.containers.contained.setitems`: all the keys
+        are checked first, and one contents changed event is sent.
+        Returns the number of items stored.
+        """
+        return setitems(self, self._setitemf, items,
+                        not self.aggregate_events)
+
+    def __delitem__(self, key):
+        if self.aggregate_events:
+            self.delitems((key,))
+        else:
+            super(LastModifiedBTreeContainer, self).__delitem__(key)
+
+    def delitems(self, keys):
+        """
+        Remove each of the *keys*. If any is missing, a
+        :class:`KeyError` is raised and nothing is removed. Unless
+        :attr:`aggregate_events` is set, this is the same as deleting
+        each key in turn.
+        """
+        keys = list(keys)
+        for key in keys:
+            if key not in self:
+                raise KeyError(key)
+        if not self.aggregate_events:
+            for key in keys:
+                del self[key]
+            return
+        for key in keys:
+            self._removeitemf(key)
+        if keys:
+            notifyContainerContentsChanged(self, removed=keys)
+
+    def _removeitemf(self, key):
+        # Remove without events for delitems
+        item = self._delitemf(key, event=False)
+        if not IBroken.providedBy(item):
+            item.__name__ = None
+            item.__parent__ = None
+        return item
+
     def clear(self):
         """
         Convenience method to clear the entire tree at one time.
         """
         if len(self) == 0:
             return
-        for k in list(self.keys()):
-            del self[k]
+        self.delitems(list(self.keys()))
+
+    def _insertitemf(self, key, value):
+        """
+        Like ``_setitemf``, but only stores *value* if *key* is new,
+        looking the key up just once. Returns whether it was stored.
+        """
+        # make sure our lazy property gets set
+        l = self._BTreeContainer__len
+        if not self._SampleContainer__data.insert(key, value):
+            return False
+        l.change(1) # pylint: disable=no-member
+        return True
+
+    def _can_insert_once(self):
+        # _insertitemf bypasses _setitemf, so it's only correct when
+        # that hasn't been overridden with more behaviour.
+        setitemf = type(self)._setitemf
+        return getattr(setitemf, '__func__', setitemf) in _INSERT_SAFE_SETITEMFS
 
     def maxKey(self):
         return self._SampleContainer__data.maxKey()
@@ -461,10 +680,14 @@ class EventlessLastModifiedBTreeContainer(LastModifiedBTreeContainer):
         __traceback_info__ = key, value
         self._checkKey(key)
         self._checkValue(value)
-        if not self._checkSame(key, value):
+        if self._can_insert_once():
+            if not self._insertitemf(key, value):
+                # To comply with the containers interface, we cannot add
+                # duplicates; re-adding the same value is a no-op
+                self._checkSame(key, value)
+        elif not self._checkSame(key, value):
             # Super's _setitemf changes the length, so only do this if
-            # it's not here already. To comply with the containers interface,
-            # we cannot add duplicates
+            # it's not here already.
             self._setitemf(key, value)
         # Should I enforce anything with the __parent__ and __name__ of
         # the value? For example, parent is not None and __name__ == key?
@@ -472,6 +695,45 @@ class EventlessLastModifiedBTreeContainer(LastModifiedBTreeContainer):
         # but more specifically useful in certain scenarios with those
         # constraints.
 
+    def setitems(self, items):
+        """
+        Store each of the (key, value) pairs in *items* (or a mapping)
+        as :meth:`__setitem__` does, without taking ownership or
+        sending events. All the keys and values are checked first, so
+        a bad one leaves the container unchanged. Returns the number of
+        items stored.
+        """
+        if getattr(items, 'items', None) is not None:
+            items = items.items()
+        todo = {}
+        for key, value in items:
+            self._checkKey(key)
+            self._checkValue(value)
+            if todo.get(key, value) is not value:
+                raise KeyError(key)
+            if not self._checkSame(key, value):
+                todo[key] = value
+        for key in sorted(todo):
+            self[key] = todo[key]
+        return len(todo)
+
+    def delitems(self, keys):
+        """
+        Remove each of the *keys*, without sending events (even with
+        :attr:`aggregate_events`). If any is missing, a
+        :class:`KeyError` is raised and nothing is removed.
+        """
+        keys = list(keys)
+        for key in keys:
+            if key not in self:
+                raise KeyError(key)
+        for key in keys:
+            self._removeitemf(key)
+
+    def _removeitemf(self, key):
+        # We don't own it, so leave its __parent__ alone
+        return self._delitemf(key, event=False)
+
     def __delitem__(self, key):
         self._delitemf(key, event=False)
 
@@ -490,16 +752,39 @@ class NOOwnershipLastModifiedBTreeContainer(LastModifiedBTreeContainer):
     """
 
     def clear(self, event=True): # pylint: disable=arguments-differ
+        if event:
+            self.delitems(list(self.keys()))
+            return
         for k in list(self.keys()):
-            if event:
-                del self[k]
-            else:
-                self._delitemf(k, event=False)
+            self._delitemf(k, event=False)
 
     def __setitem__(self, key, value):
-        no_ownership_setitem(self, self._setitemf, key, value)
+        if self.aggregate_events:
+            no_ownership_setitems(self, self._setitemf, ((key, value),), False)
+        else:
+            insertitemf = self._insertitemf if self._can_insert_once() else None
+            no_ownership_setitem(self, self._setitemf, key, value,
+                                 insertitemf)
+
+    def setitems(self, items, event=True): # pylint: disable=arguments-differ
+        """
+        Store each of the (key, value) pairs in *items* (or a mapping)
+        with :func:`~nti.containers.contained.no_ownership_setitems`:
+        all the keys are checked first and one contents changed event
+        is sent. If *event* is false, no per-object added events are
+        sent.
+        """
+        event = event and not self.aggregate_events
+        return no_ownership_setitems(self, self._setitemf, items, event)
+
+    def _removeitemf(self, key):
+        # We don't own it, so leave its __parent__ alone
+        return self._delitemf(key, event=False)
 
     def __delitem__(self, key):
+        if self.aggregate_events:
+            self.delitems((key,))
+            return
         # make sure our lazy property gets set
         l = self._BTreeContainer__len
         item = self._SampleContainer__data[key]
@@ -612,7 +897,13 @@ class CaseInsensitiveLastModifiedBTreeContainer(LastModifiedBTreeContainer):
     def _setitemf(self, key, value):
         LastModifiedBTreeContainer._setitemf(self, _tx_key_insen(key), value)
 
+    def _insertitemf(self, key, value):
+        return LastModifiedBTreeContainer._insertitemf(self, _tx_key_insen(key), value)
+
     def __delitem__(self, key):
+        if self.aggregate_events:
+            self.delitems((key,))
+            return
         # deleting is somewhat complicated by the need to broadcast
         # events with the original case
         l = self._BTreeContainer__len
@@ -702,6 +993,14 @@ class CaseInsensitiveCheckingLastModifiedBTreeContainer(_CheckObjectOnSetMixin,
     pass
 
 
+#: The ``_setitemf`` implementations that have a matching
+#: ``_insertitemf``.
+_INSERT_SAFE_SETITEMFS = frozenset(getattr(f, '__func__', f)
+                                   for f in (BTreeContainer._setitemf,
+                                             _CheckObjectOnSetMixin._setitemf,
+                                             CaseInsensitiveLastModifiedBTreeContainer._setitemf))
+
+
 deferredimport.deprecated(
     "Import from nti.containers.datastructures instead",
     _marker='nti.containers.datastructures:_marker',
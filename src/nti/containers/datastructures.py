@@ -8,7 +8,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import six
 import time
+import zlib
+import heapq
+import random
+from itertools import islice
 from collections import Sized
 from collections import Mapping
 from collections import Iterable
@@ -26,6 +31,8 @@ from zope.intid.interfaces import IIntIds
 
 from zope.location.interfaces import ILocation
 
+import transaction
+
 from ZODB import loglevels
 
 from persistent import Persistent
@@ -34,7 +41,7 @@ import BTrees
 
 from BTrees.Length import Length
 
-from nti.containers.common import discard_p
+from nti.containers.common import discard
 
 from nti.containers.mixins import DictMixin
 
@@ -75,10 +82,25 @@ class _AbstractIntidResolvingFacade(object):
         if intids is not None:
             self._intids = intids
 
+    #: How many intids this facade (or the facades it produced) failed
+    #: to resolve, when missing objects are allowed.
+    missing_count = 0
+
+    def _note_missing(self, iid):
+        self.missing_count += 1
+        parent = self.__parent__
+        if isinstance(parent, _AbstractIntidResolvingFacade):
+            parent._note_missing(iid)
+
     def __reduce__(self):
         raise TypeError("Transient object; should not be pickled")
 
 
+#: Returned by :meth:`IntidResolvingIterable._resolve` for intids that
+#: cannot be resolved.
+_MISSING = object()
+
+
 class IntidResolvingIterable(_AbstractIntidResolvingFacade,
                              Iterable,
                              Container,
@@ -88,48 +110,162 @@ class IntidResolvingIterable(_AbstractIntidResolvingFacade,
     goes. Typically this will be a :mod:`BTrees` IISet of some family.
     """
 
+    def _get_intids(self):
+        if self._intids is not None:
+            return self._intids
+        return component.getUtility(IIntIds)
+
+    def _resolve(self, intids, iid, allow_missing, note_missing=True):
+        """
+        Resolve a single intid, returning :data:`_MISSING` if it cannot
+        be resolved and *allow_missing* is true. Such intids are counted
+        in :attr:`missing_count` only if *note_missing* is true.
+        """
+        # pylint: disable=unused-variable
+        __traceback_info__ = iid, self.__parent__, self.__name__
+        try:
+            return intids.getObject(iid)
+        except TypeError:
+            # Raised when we send a string or something, which means we do not actually
+            # have an IISet. This is a sign of an object missed during
+            # migration
+            if not allow_missing:
+                raise
+            logger.log(loglevels.TRACE,
+                       "Incorrect key '%s' in %r of %r",
+                       iid, self.__name__, self.__parent__)
+        except KeyError:
+            if not allow_missing:
+                raise
+            logger.log(loglevels.TRACE,
+                       "Failed to resolve key '%s' in %r of %r",
+                       iid, self.__name__, self.__parent__)
+        if note_missing:
+            self._note_missing(iid)
+        return _MISSING
+
     def __iter__(self, allow_missing=None):
         allow_missing = allow_missing or self._allow_missing
-        if self._intids is not None:
-            intids = self._intids
-        else:
-            intids = component.getUtility(IIntIds)
+        intids = self._get_intids()
         for iid in self.context:
-            # pylint: disable=unused-variable
-            __traceback_info__ = iid, self.__parent__, self.__name__
-            try:
-                yield intids.getObject(iid)
-            except TypeError:
-                # Raised when we send a string or something, which means we do not actually
-                # have an IISet. This is a sign of an object missed during
-                # migration
-                if not allow_missing:
-                    raise
-                logger.log(loglevels.TRACE,
-                           "Incorrect key '%s' in %r of %r",
-                           iid, self.__name__, self.__parent__)
-            except KeyError:
-                if not allow_missing:
-                    raise
-                logger.log(loglevels.TRACE,
-                           "Failed to resolve key '%s' in %r of %r",
-                           iid, self.__name__, self.__parent__)
+            obj = self._resolve(intids, iid, allow_missing)
+            if obj is not _MISSING:
+                yield obj
+
+    #: If set, a callable (usually a :class:`BTrees.Length.Length`) that
+    #: returns the length of the context more efficiently than asking it
+    #: directly.
+    _len = None
 
     def __len__(self):
         """
         This is only guaranteed to be accurate with `allow_missing` is ``False``.
         """
+        if self._len is not None:
+            return self._len()
         return len(self.context)
 
     def __contains__(self, obj):
         """
         Is the given object in the container? This is implemented as a linear check.
+
+        Intids that can't be resolved are skipped without being counted
+        in :attr:`missing_count`, which only counts those met while
+        iterating.
         """
-        for other in self.__iter__(allow_missing=True):
-            if other == obj:
+        intids = self._get_intids()
+        for iid in self.context:
+            other = self._resolve(intids, iid, True, note_missing=False)
+            if other is not _MISSING and other == obj:
                 return True
 
 
+class PrefetchingIntidResolvingIterable(IntidResolvingIterable):
+    """
+    An :class:`IntidResolvingIterable` that reads ahead while iterating.
+
+    Intids are resolved a chunk of :attr:`readahead` at a time. Before
+    the objects of one chunk are handed to the consumer, the next chunk
+    is resolved and its (ghost) objects are passed to
+    :meth:`ZODB.Connection.Connection.prefetch`, letting storages that
+    support it (ZEO, RelStorage) load their state in the background
+    while the consumer works. Because the prefetch goes through the
+    objects' own connection it sees exactly the same MVCC snapshot as
+    the consumer.
+
+    If :attr:`ghost_consumed` is true, each object is deactivated
+    (turned back into a ghost, unless it has been modified) once the
+    consumer has moved on to the next chunk, so that at most two chunks
+    of objects are kept active by the iteration.
+    """
+
+    #: How many intids to resolve and prefetch at a time.
+    readahead = 100
+
+    #: Whether to ghost objects the consumer is done with.
+    ghost_consumed = False
+
+    def __init__(self, context, allow_missing=False,
+                 parent=None, name=None, intids=None,
+                 readahead=None, ghost_consumed=None):
+        super(PrefetchingIntidResolvingIterable, self).__init__(context,
+                                                                allow_missing=allow_missing,
+                                                                parent=parent,
+                                                                name=name,
+                                                                intids=intids)
+        if readahead is not None:
+            if readahead < 1:
+                raise ValueError("readahead must be positive", readahead)
+            self.readahead = readahead
+        if ghost_consumed is not None:
+            self.ghost_consumed = ghost_consumed
+
+    @staticmethod
+    def _prefetch(objects):
+        jars = {}
+        for obj in objects:
+            jar = getattr(obj, '_p_jar', None)
+            if jar is not None and getattr(obj, '_p_oid', None) is not None:
+                jars.setdefault(id(jar), (jar, []))[1].append(obj)
+        for jar, ghosts in jars.values():
+            prefetch = getattr(jar, 'prefetch', None)
+            if prefetch is not None:  # ZODB >= 5
+                prefetch(ghosts)
+
+    @staticmethod
+    def _ghost(objects):
+        for obj in objects:
+            deactivate = getattr(obj, '_p_deactivate', None)
+            if deactivate is not None:
+                deactivate()
+
+    def _chunks(self, allow_missing):
+        intids = self._get_intids()
+        iids = iter(self.context)
+        while True:
+            chunk = [self._resolve(intids, iid, allow_missing)
+                     for iid in islice(iids, self.readahead)]
+            if not chunk:
+                break
+            chunk = [x for x in chunk if x is not _MISSING]
+            self._prefetch(chunk)
+            yield chunk
+
+    def __iter__(self, allow_missing=None):
+        allow_missing = allow_missing or self._allow_missing
+        chunks = self._chunks(allow_missing)
+        # Keep one chunk resolved and prefetching ahead of the one
+        # being consumed
+        current = next(chunks, None)
+        while current is not None:
+            upcoming = next(chunks, None)
+            for obj in current:
+                yield obj
+            if self.ghost_consumed:
+                self._ghost(current)
+            current = upcoming
+
+
 class IntidResolvingMappingFacade(_AbstractIntidResolvingFacade,
                                   DictMixin,
                                   Mapping):
@@ -183,14 +319,43 @@ class _LengthIntidResolvingMappingFacade(IntidResolvingMappingFacade):
 
     def _wrap(self, key, val):
         # pylint: disable=protected-access
+        if isinstance(val, tuple):
+            val = _InlineContainer(self.__parent__, key)
         wrapped = super(_LengthIntidResolvingMappingFacade, self)._wrap(key, val)
         wrapped.lastModified = self.__parent__._get_container_mod_time(key)
+        length = self.__parent__._query_container_length(key)
+        if length is not None:
+            wrapped._len = length
         return wrapped
 
     def __len__(self):
         return self._len()
 
 
+class _InlineContainer(object):
+    """
+    A live view of a small container that a :class:`IntidContainedStorage`
+    stores inline. Those are replaced, not mutated, when they change.
+    """
+
+    __slots__ = ('_storage', '_containerId')
+
+    def __init__(self, storage, containerId):
+        self._storage = storage
+        self._containerId = containerId
+
+    def _current(self):
+        # pylint: disable=protected-access
+        result = self._storage._lookup_container(self._containerId)
+        return result if result is not None else ()
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
+
+
 _marker = object()
 
 
@@ -207,7 +372,44 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
 
     family = BTrees.family64
 
-    def __init__(self, family=None):
+    #: The inverted index of modification times (see
+    #: :meth:`containers_modified_since`). Storages created before
+    #: it existed have none until :meth:`rebuildModificationIndex` is run.
+    _moddate_index = None
+
+    #: The number of shards in the modification time index. All writers
+    #: add their entries to the newest end of the index, so it is split
+    #: to keep that end from becoming a hot spot. Changing this requires
+    #: rebuilding the index.
+    _moddate_index_shards = 8
+
+    #: Containers holding no more than this many intids are stored
+    #: directly in ``_containers`` as a sorted tuple, avoiding a separate
+    #: TreeSet (and length counter) record for each one. Once a container
+    #: grows past this it is promoted to a TreeSet, and it is never
+    #: demoted. Note that changing an inline container rewrites the
+    #: ``_containers`` bucket that holds it. Bucket conflict resolution
+    #: merges concurrent changes to different containers, but concurrent
+    #: changes to the same inline container conflict (where a TreeSet
+    #: could merge them). Set this to 0 to always use TreeSets.
+    _inline_container_threshold = 10
+
+    #: Removing intids from a TreeSet container probes for each one,
+    #: unless there are at least 1/this many as there are in the
+    #: container; then it's cheaper to intersect with the whole set.
+    _bulk_removal_factor = 16
+
+    #: The optional map from intid to the containerIds holding it
+    #: (see :meth:`enableReverseIndex`).
+    _reverse_index = None
+
+    def __init__(self, family=None, reverse_index=False):
+        """
+        :keyword bool reverse_index: If true, maintain an index from each
+                intid to the containers that hold it. This makes
+                :meth:`containersOf` and :meth:`removeIntidEverywhere`
+                efficient at the cost of more writes.
+        """
         super(IntidContainedStorage, self).__init__()
         if family is not None:
             self.family = family
@@ -219,8 +421,53 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
         # Map from string container ids to self.family.II.TreeSet
         # { 'containerId': II.TreeSet() }
         # The values in the TreeSet are the intids of the shared
-        # objects. Remember that len() of them is not efficient.
-        self._containers = self.family.OO.BTree()
+        # objects. Remember that len() of them is not efficient; we
+        # keep separate counters for that (see __lengths).
+        # Small containers are a sorted tuple of intids instead
+        # (see _inline_container_threshold).
+        # All of our trees are keyed by _container_key(containerId),
+        # which here is just the containerId.
+        self._containers = self._new_container_tree()
+
+        # Map from shard number to family.OO.TreeSet of
+        # (64-bit time, container key) pairs; the inverse of __moddates
+        self._moddate_index = self.family.IO.BTree()
+
+        if reverse_index:
+            self.enableReverseIndex()
+
+    def _new_container_tree(self):
+        return self.family.OO.BTree()
+
+    def _new_container_date_tree(self):
+        return self.family.OI.BTree()
+
+    def _new_container_key_set(self):
+        return self.family.OO.TreeSet()
+
+    def _container_key(self, containerId, create=False):
+        """
+        The key our trees use for *containerId*, or None if there can
+        be no such container (and *create* is false).
+        """
+        return containerId
+
+    def _container_id(self, key):
+        """
+        The inverse of :meth:`_container_key`.
+        """
+        return key
+
+    def _container_map(self):
+        """
+        The mapping from containerId to intid set wrapped by
+        :attr:`containers`.
+        """
+        return self._containers
+
+    def _lookup_container(self, containerId):
+        key = self._container_key(containerId)
+        return self._containers.get(key) if key is not None else None
 
     def __iter__(self):
         return iter(self._containers)
@@ -241,16 +488,72 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
         OF map from containerId to (int) date of last modification,
         since we cannot store them on the TreeSet itself
         """
-        result = self.family.OI.BTree()
+        result = self._new_container_date_tree()
+        # pylint: disable=protected-access,attribute-defined-outside-init
+        self._p_changed = True
+        return result
+
+    @Lazy
+    def _IntidContainedStorage__lengths(self):
+        """
+        OO map from containerId to a :class:`BTrees.Length.Length` counting
+        the intids in that container, since ``len()`` of a TreeSet must
+        walk all of its buckets.
+        """
+        result = self._new_container_tree()
         # pylint: disable=protected-access,attribute-defined-outside-init
         self._p_changed = True
         return result
 
+    def _query_container_length(self, containerId):
+        self._p_activate()
+        if '_IntidContainedStorage__lengths' not in self.__dict__:
+            return None
+        key = self._container_key(containerId)
+        return self.__lengths.get(key) if key is not None else None
+
+    def _change_container_length(self, key, container_set, delta):
+        lengths = self.__lengths
+        length = lengths.get(key)
+        if length is None:
+            # A container from before we kept counters. The set already
+            # reflects this change.
+            lengths[key] = Length(len(container_set))
+        else:
+            length.change(delta)
+
+    def updateContainerLengths(self):
+        """
+        Make sure that every container has an accurate length counter.
+        This is a one-time backfill for storages created before the
+        counters existed; it is linear in the total number of intids.
+
+        :return: The number of counters that were created or corrected.
+        """
+        lengths = self.__lengths
+        result = 0
+        for key, container_set in self._containers.items():
+            if isinstance(container_set, tuple):
+                # Inline containers know their length
+                continue
+            actual = len(container_set)
+            length = lengths.get(key)
+            if length is None:
+                lengths[key] = Length(actual)
+                result += 1
+            elif length() != actual:
+                length.set(actual)
+                result += 1
+        return result
+
     def _get_container_mod_time(self, containerId):
         self._p_activate()
         if '_IntidContainedStorage__moddates' not in self.__dict__:
             return 0
-        data = self.__moddates.get(containerId, ZERO_64BIT_INT)
+        key = self._container_key(containerId)
+        if key is None:
+            return 0
+        data = self.__moddates.get(key, ZERO_64BIT_INT)
         return bit64_int_to_time(data)
 
     def __len__(self):
@@ -264,12 +567,14 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
         Returns an object that has a `values` method that iterates
         the list-like (immutable) containers.
 
-        .. note:: It is not efficient to get the length of the list-like
-                containers; it is however, efficient, to test their boolean
-                status (empty or not) and to get the length of the overall returned
-                object.
+        .. note:: The length of the list-like containers comes from a
+                counter maintained for each container, so it is efficient.
+                Containers created before the counters existed fall back to
+                the (inefficient) length of the set until
+                :meth:`updateContainerLengths` is run or they are next
+                modified.
         """
-        return _LengthIntidResolvingMappingFacade(self._containers,
+        return _LengthIntidResolvingMappingFacade(self._container_map(),
                                                   allow_missing=True,
                                                   parent=self,
                                                   name='SharedContainedObjectStorage',
@@ -286,28 +591,325 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
     def _get_intid_for_object_from_utility(self, contained):
         return component.getUtility(IIntIds).getId(contained)
 
+    def _get_moddate_index_shard(self, key):
+        if not isinstance(key, bytes):
+            key = six.text_type(key).encode('utf-8')
+        # crc32 (unlike hash()) is stable across processes
+        shard_id = (zlib.crc32(key) & 0xffffffff) % self._moddate_index_shards
+        index = self._moddate_index
+        shard = index.get(shard_id)
+        if shard is None:
+            shard = index[shard_id] = self.family.OO.TreeSet()
+        return shard
+
+    def _set_container_mod_time(self, key, now=None):
+        if now is None:
+            now = time.time()
+        moddates = self.__moddates
+        new = time_to_64bit_int(now)
+        if self._moddate_index is not None:
+            old = moddates.get(key)
+            if old == new:
+                return
+            shard = self._get_moddate_index_shard(key)
+            if old is not None:
+                discard(shard, (old, key))
+            shard.add((new, key))
+        moddates[key] = new
+
+    def _remove_container_mod_time(self, key):
+        old = self.__moddates.pop(key)
+        if self._moddate_index is not None:
+            discard(self._get_moddate_index_shard(key), (old, key))
+
+    def rebuildModificationIndex(self):
+        """
+        Create (or re-create) the index used by
+        :meth:`containers_modified_since` from the modification dates
+        of all containers.
+
+        :return: The number of containers indexed.
+        """
+        moddates = self.__moddates
+        self._moddate_index = self.family.IO.BTree()
+        for key, t in moddates.items():
+            self._get_moddate_index_shard(key).add((t, key))
+        return len(moddates)
+
+    def containers_modified_since(self, since, limit=None, after=None):
+        """
+        Find the containers whose last modification was at or after
+        *since* (a :func:`time.time` value), least recently modified
+        first. With the index this costs O(log n + k).
+
+        To page through the results, pass the time and containerId of
+        the last item of the previous page as *since* and *after*.
+
+        :return: A list of ``(containerId, lastModified)`` pairs.
+        """
+        self._p_activate()
+        if '_IntidContainedStorage__moddates' not in self.__dict__:
+            return []
+        lo = time_to_64bit_int(since)
+        if after is not None:
+            after = self._container_key(after)
+        lo = (lo,) if after is None else (lo, after)
+        index = self._moddate_index
+        if index is None:
+            # No index; this is a scan of all the containers
+            merged = sorted(x for x in ((t, k) for k, t in self.__moddates.items())
+                            if x > lo)
+        else:
+            merged = heapq.merge(*[shard.keys(lo, excludemin=after is not None)
+                                   for shard in index.values()])
+        return [(self._container_id(key), bit64_int_to_time(t))
+                for t, key in islice(merged, limit)]
+
+    def _add_intids_to_container(self, key, intids):
+        """
+        Add the *intids* to the container, creating it if needed, and
+        return how many were not already present.
+        """
+        containers = self._containers
+        container_set = containers.get(key)
+        created = container_set is None
+        if created:
+            self.__len.change(1)
+            container_set = ()
+        if self._reverse_index is not None:
+            intids = tuple(intids)
+            for intid in intids:
+                self._add_reverse_entry(intid, key)
+
+        if not isinstance(container_set, tuple):
+            result = container_set.update(intids)
+            if result:
+                self._change_container_length(key, container_set, result)
+            return result
+
+        family = self.family.II
+        merged = family.union(family.Set(container_set), family.Set(intids))
+        result = len(merged) - len(container_set)
+        if len(merged) > self._inline_container_threshold:
+            # Promote to a real set, which now needs a counter
+            containers[key] = family.TreeSet(merged)
+            self.__lengths[key] = Length(len(merged))
+        elif result or created:
+            containers[key] = tuple(merged)
+        return result
+
+    def _remove_intids_from_container(self, key, intids):
+        """
+        Remove the *intids* from the container and return how many were
+        actually present, or None if there is no such container.
+        """
+        if key is None:
+            return None
+        containers = self._containers
+        container_set = containers.get(key)
+        if container_set is None:
+            return None
+        family = self.family.II
+        if isinstance(container_set, tuple):
+            present = family.intersection(family.Set(container_set),
+                                          family.Set(intids))
+            if present:
+                remaining = family.difference(family.Set(container_set), present)
+                containers[key] = tuple(remaining)
+        else:
+            intids = tuple(intids)
+            # pylint: disable=no-member
+            lengths = self.__dict__.get('_IntidContainedStorage__lengths')
+            length = lengths.get(key) if lengths is not None else None
+            if     length is not None \
+                and len(intids) * self._bulk_removal_factor >= length():
+                # Big enough to be worth merging with the whole set.
+                # Only the intids that are actually present need to be
+                # removed (and counted)
+                present = family.intersection(container_set, family.Set(intids))
+                for intid in present:
+                    container_set.remove(intid)
+            else:
+                # One probe each
+                present = []
+                for intid in intids:
+                    try:
+                        container_set.remove(intid)
+                    except KeyError:
+                        continue
+                    present.append(intid)
+            if present:
+                self._change_container_length(key, container_set,
+                                              -len(present))
+        if self._reverse_index is not None:
+            for intid in present:
+                self._remove_reverse_entry(intid, key)
+        return len(present)
+
+    def _add_reverse_entry(self, intid, key):
+        index = self._reverse_index
+        keys = index.get(intid)
+        if keys is None:
+            keys = index[intid] = self._new_container_key_set()
+        keys.add(key)
+
+    def _remove_reverse_entry(self, intid, key):
+        index = self._reverse_index
+        keys = index.get(intid)
+        if keys is not None:
+            discard(keys, key)
+            if not keys:
+                del index[intid]
+
+    def enableReverseIndex(self):
+        """
+        Create (or re-create) the index from each intid to the containers
+        that hold it, and keep it up to date from now on.
+
+        :return: The number of intids indexed.
+        """
+        self._reverse_index = self.family.IO.BTree()
+        for key, container_set in self._containers.items():
+            for intid in container_set:
+                self._add_reverse_entry(intid, key)
+        return len(self._reverse_index)
+
+    def _container_keys_for_intid(self, intid):
+        if self._reverse_index is not None:
+            return list(self._reverse_index.get(intid, ()))
+        return [key
+                for key, container_set in self._containers.items()
+                if intid in container_set]
+
+    def containerIdsForIntid(self, intid):
+        """
+        The ids of the containers that hold the given intid. This is
+        O(log n) with the reverse index and a scan of every container
+        without it.
+        """
+        return [self._container_id(key)
+                for key in self._container_keys_for_intid(intid)]
+
+    def containersOf(self, contained):
+        """
+        The ids of the containers that hold the given object.
+        """
+        self._check_contained_object_for_storage(contained)
+        return self.containerIdsForIntid(self._get_intid_for_object(contained))
+
+    def removeIntidEverywhere(self, intid):
+        """
+        Remove the intid from every container that holds it.
+
+        :return: The number of containers it was removed from.
+        """
+        keys = self._container_keys_for_intid(intid)
+        now = time.time()
+        for key in keys:
+            self._remove_intids_from_container(key, (intid,))
+            self._set_container_mod_time(key, now)
+        return len(keys)
+
+    def _intids_for_objects(self, objects):
+        result = []
+        for contained in objects:
+            self._check_contained_object_for_storage(contained)
+            result.append(self._get_intid_for_object(contained))
+        return result
+
     def addContainedObjectToContainer(self, contained, containerId=''):
         """
         Defaults to the unnamed container
         """
         self._check_contained_object_for_storage(contained)
-
-        container_set = self._containers.get(containerId)
-        if container_set is None:
-            _len = self.__len
-            container_set = self.family.II.TreeSet()
-            self._containers[containerId] = container_set
-            _len.change(1)
-        container_set.add(self._get_intid_for_object(contained))
-        self.__moddates[containerId] = time_to_64bit_int(time.time())
+        key = self._container_key(containerId, create=True)
+        self._add_intids_to_container(key, (self._get_intid_for_object(contained),))
+        self._set_container_mod_time(key)
         return contained
 
+    def addContainedObjectsToContainer(self, objects, containerId=''):
+        """
+        Add all of the *objects* to the given container in a single
+        operation. Defaults to the unnamed container.
+
+        :return: The number of objects that were not already
+                in the container.
+        """
+        intids = self._intids_for_objects(objects)
+        if not intids:
+            return 0
+        key = self._container_key(containerId, create=True)
+        result = self._add_intids_to_container(key, intids)
+        self._set_container_mod_time(key)
+        return result
+
+    def addContainedObjectToContainers(self, contained, containerIds):
+        """
+        Add the *contained* object to each of the given containers, looking
+        up its intid only once.
+
+        :return: The number of containers that did not already
+                hold the object.
+        """
+        self._check_contained_object_for_storage(contained)
+        intids = (self._get_intid_for_object(contained),)
+        now = time.time()
+        result = 0
+        for containerId in containerIds:
+            key = self._container_key(containerId, create=True)
+            result += self._add_intids_to_container(key, intids)
+            self._set_container_mod_time(key, now)
+        return result
+
     def deleteContainedObjectIdFromContainer(self, intid, containerId):
-        container_set = self._containers.get(containerId)
-        if container_set is not None:
-            result = discard_p(container_set, intid)
-            self.__moddates[containerId] = time_to_64bit_int(time.time())
-            return result
+        key = self._container_key(containerId)
+        result = self._remove_intids_from_container(key, (intid,))
+        if result is not None:
+            self._set_container_mod_time(key)
+            return bool(result)
+
+    def deleteContainedObjectIdsFromContainer(self, intids, containerId):
+        """
+        Remove all of the *intids* from the given container in a single
+        operation.
+
+        :return: The number of intids that were actually removed, or
+                None if there is no such container.
+        """
+        key = self._container_key(containerId)
+        result = self._remove_intids_from_container(key, intids)
+        if result is not None:
+            self._set_container_mod_time(key)
+        return result
+
+    def deleteEqualContainedObjectsFromContainer(self, objects, containerId=''):
+        """
+        Remove all of the *objects* from the given container in a single
+        operation. Defaults to the unnamed container.
+
+        :return: The number of objects that were removed.
+        """
+        intids = self._intids_for_objects(objects)
+        return self.deleteContainedObjectIdsFromContainer(intids, containerId) or 0
+
+    def deleteEqualContainedObjectFromContainers(self, contained, containerIds):
+        """
+        Remove the *contained* object from each of the given containers,
+        looking up its intid only once.
+
+        :return: The number of containers the object was removed from.
+        """
+        self._check_contained_object_for_storage(contained)
+        intids = (self._get_intid_for_object(contained),)
+        now = time.time()
+        result = 0
+        for containerId in containerIds:
+            key = self._container_key(containerId)
+            removed = self._remove_intids_from_container(key, intids)
+            if removed is not None:
+                result += removed
+                self._set_container_mod_time(key, now)
+        return result
 
     def deleteEqualContainedObjectFromContainer(self, contained, containerId=''):
         """
@@ -332,15 +934,99 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
         return self.deleteEqualContainedObjectFromContainer(contained,
                                                             contained.containerId)
 
+    def _wrap_intids(self, intids, name):
+        return IntidResolvingIterable(intids, allow_missing=True,
+                                      parent=self, name=name)
+
+    def _as_set(self, container_set):
+        if isinstance(container_set, tuple):
+            return self.family.II.Set(container_set)
+        return container_set
+
+    def _union_intids(self, containerIds):
+        sets = [self._lookup_container(containerId) for containerId in containerIds]
+        return self.family.II.multiunion([self._as_set(x) for x in sets
+                                          if x is not None])
+
+    def _intersection_intids(self, containerIds):
+        family = self.family.II
+        sized = []
+        for containerId in containerIds:
+            container_set = self._lookup_container(containerId)
+            if container_set is None:
+                return family.Set()
+            length = self._query_container_length(containerId)
+            size = length() if length is not None else len(container_set)
+            sized.append((size, container_set))
+        if not sized:
+            return family.Set()
+        # Smallest first keeps the intermediate results small
+        sized.sort(key=lambda x: x[0])
+        result = family.Set(sized[0][1])
+        for _, container_set in sized[1:]:
+            if not result:
+                break
+            result = family.intersection(result, self._as_set(container_set))
+        return result
+
+    def union(self, containerIds):
+        """
+        The objects found in any of the given containers. Unknown
+        containers are ignored.
+
+        :return: An :class:`IntidResolvingIterable` that resolves
+                objects only as it is iterated.
+        """
+        return self._wrap_intids(self._union_intids(containerIds), 'union')
+
+    def intersection(self, containerIds):
+        """
+        The objects found in every one of the given containers. If any
+        container is unknown, this is empty.
+
+        :return: An :class:`IntidResolvingIterable` that resolves
+                objects only as it is iterated.
+        """
+        return self._wrap_intids(self._intersection_intids(containerIds),
+                                 'intersection')
+
+    def difference(self, containerIds, excludedContainerIds, intersect=False):
+        """
+        The objects found in any of *containerIds* (or, if *intersect* is
+        true, in all of them) but not in any of *excludedContainerIds*.
+
+        :return: An :class:`IntidResolvingIterable` that resolves
+                objects only as it is iterated.
+        """
+        if intersect:
+            included = self._intersection_intids(containerIds)
+        else:
+            included = self._union_intids(containerIds)
+        excluded = self._union_intids(excludedContainerIds)
+        return self._wrap_intids(self.family.II.difference(included, excluded),
+                                 'difference')
+
     def getContainer(self, containerId, defaultValue=None):
         # pylint: disable=no-member
         return self.containers.get(containerId, default=defaultValue)
 
+    def _as_tree_set(self, container_set):
+        if isinstance(container_set, tuple):
+            return self.family.II.TreeSet(container_set)
+        return container_set
+
     def popContainer(self, containerId, default=_marker):
         try:
             _len = self.__len
-            result = self._containers.pop(containerId)
-            self.__moddates.pop(containerId)
+            key = self._container_key(containerId)
+            if key is None:
+                raise KeyError(containerId)
+            result = self._as_tree_set(self._containers.pop(key))
+            self._remove_container_mod_time(key)
+            if self._reverse_index is not None:
+                for intid in result:
+                    self._remove_reverse_entry(intid, key)
+            self.__lengths.pop(key, None)
             _len.change(-1)
             return result
         except KeyError:
@@ -348,6 +1034,46 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
                 return default
             raise
 
+    def _dangling_intids(self, container_set, refs):
+        family = self.family.II
+        if isinstance(container_set, tuple):
+            container_set = family.Set(container_set)
+        try:
+            return family.difference(container_set, refs)
+        except TypeError:  # pragma: no cover
+            # refs is from a different BTree family
+            return family.Set([x for x in container_set if x not in refs])
+
+    def removeDanglingIntids(self, intids=None, start=None, limit=None):
+        """
+        Remove intids that no longer resolve from the containers.
+
+        Each container is checked against the intid utility's reverse
+        map with a single set difference; the dead intids are then
+        removed together.
+
+        :keyword start: If given, only containers after this internal
+            container key are examined.
+        :keyword int limit: If given, at most this many containers are
+            examined.
+        :return: A tuple ``(removed, last)`` of the number of intids
+            removed and the key of the last container examined (or
+            None if there were none). Passing *last* back as *start*
+            continues the sweep.
+        """
+        if intids is None:
+            intids = component.getUtility(IIntIds)
+        refs = intids.refs
+        keys = self._containers.keys(min=start, excludemin=start is not None)
+        last = None
+        removed = 0
+        for key in list(islice(keys, limit)):
+            last = key
+            dead = self._dangling_intids(self._containers[key], refs)
+            if dead:
+                removed += self._remove_intids_from_container(key, dead)
+        return removed, last
+
     __repr__ = make_repr(lambda self: '<%s %s/%s>' % (self.__class__.__name__,
                                                       self.__parent__,
                                                       self.__name__))
@@ -358,8 +1084,8 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
     get = getContainer
     pop = popContainer
 
-    def __contains__(self, key):
-        return key in self._containers
+    def __contains__(self, containerId):
+        return self._lookup_container(containerId) is not None
 
     def keys(self):
         return self._containers.keys()
@@ -371,3 +1097,178 @@ class IntidContainedStorage(Persistent, Contained, Iterable, Container, Sized):
     def items(self):
         # pylint: disable=no-member
         return self.containers.items()  # unwrapping
+
+
+class ContainerIdInterner(Persistent):
+    """
+    Maps container ids (usually long NTIID strings) to compact integers,
+    and back. One interner can be shared by many
+    :class:`InternedIntidContainedStorage` objects so that each
+    containerId is stored only once.
+    """
+
+    family = BTrees.family64
+
+    #: The next id to try. Like :mod:`zope.intid`, we allocate ids
+    #: sequentially within a process (so they are likely to share
+    #: buckets) from a random start (so that concurrent processes are
+    #: unlikely to conflict).
+    _v_nextid = None
+
+    def __init__(self, family=None):
+        super(ContainerIdInterner, self).__init__()
+        if family is not None:
+            self.family = family
+        # containerId -> int
+        self._ids = self.family.OI.BTree()
+        # int -> containerId
+        self._containerIds = self.family.IO.BTree()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def queryId(self, containerId, default=None):
+        return self._ids.get(containerId, default)
+
+    def getId(self, containerId):
+        """
+        The integer for the containerId, allocating one if needed.
+        """
+        result = self._ids.get(containerId)
+        if result is None:
+            result = self._generateId()
+            self._ids[containerId] = result
+            self._containerIds[result] = containerId
+        return result
+
+    def getContainerId(self, uid):
+        return self._containerIds[uid]
+
+    def _generateId(self):
+        nextid = self._v_nextid
+        while True:
+            if nextid is None or nextid > self.family.maxint:
+                nextid = random.randrange(0, self.family.maxint)
+            uid = nextid
+            nextid += 1
+            if uid not in self._containerIds:
+                self._v_nextid = nextid
+                return uid
+            nextid = None
+
+    __repr__ = make_repr(lambda self: '<%s %s>' % (self.__class__.__name__,
+                                                   len(self)))
+
+
+class _InternedContainerMap(object):
+    """
+    A read-only view of the integer-keyed containers of an
+    :class:`InternedIntidContainedStorage` keyed by containerId.
+    """
+
+    __slots__ = ('_storage',)
+
+    def __init__(self, storage):
+        self._storage = storage
+
+    def __getitem__(self, containerId):
+        # pylint: disable=protected-access
+        result = self._storage._lookup_container(containerId)
+        if result is None:
+            raise KeyError(containerId)
+        return result
+
+    def __contains__(self, containerId):
+        return containerId in self._storage
+
+    def __iter__(self):
+        return iter(self._storage)
+
+    def keys(self):
+        return self._storage.keys()
+
+    def iteritems(self):
+        # pylint: disable=protected-access
+        storage = self._storage
+        return ((storage._container_id(key), container_set)
+                for key, container_set in storage._containers.items())
+
+    def __len__(self):
+        return len(self._storage)
+
+
+class InternedIntidContainedStorage(IntidContainedStorage):
+    """
+    An :class:`IntidContainedStorage` that stores its containerIds
+    once, in a :class:`ContainerIdInterner`, and keys its own trees with
+    the compact integers the interner assigns. This makes for smaller
+    buckets and faster comparisons than string keys. The API is still in
+    terms of containerIds, but note that iteration follows the order of
+    the integers, not of the containerIds.
+    """
+
+    def __init__(self, family=None, reverse_index=False, interner=None):
+        """
+        :keyword interner: The :class:`ContainerIdInterner` to use. Pass
+                the same one to many storages to share it; by default,
+                each storage gets its own.
+        """
+        super(InternedIntidContainedStorage, self).__init__(family, reverse_index)
+        if interner is None:
+            interner = ContainerIdInterner(self.family)
+        self.interner = interner
+
+    def _new_container_tree(self):
+        return self.family.IO.BTree()
+
+    def _new_container_date_tree(self):
+        return self.family.II.BTree()
+
+    def _new_container_key_set(self):
+        return self.family.II.TreeSet()
+
+    def _container_key(self, containerId, create=False):
+        if create:
+            return self.interner.getId(containerId)
+        return self.interner.queryId(containerId)
+
+    def _container_id(self, key):
+        return self.interner.getContainerId(key)
+
+    def _container_map(self):
+        return _InternedContainerMap(self)
+
+    def __iter__(self):
+        return (self._container_id(key) for key in self._containers)
+
+    def keys(self):
+        return list(self)
+
+
+def sweep_dangling_intids(storage, intids=None, batch_size=100,
+                          transaction_manager=None):
+    """
+    Remove the dangling intids from all the containers of *storage*,
+    committing a transaction after each *batch_size* containers.
+
+    This is meant to be run offline, for example from a script; the
+    storage must be reachable from *transaction_manager*'s connection
+    (by default, the thread-local :mod:`transaction` manager).
+
+    :return: The total number of intids removed.
+    """
+    if transaction_manager is None:
+        transaction_manager = transaction.manager
+    total = 0
+    start = None
+    while True:
+        removed, start = storage.removeDanglingIntids(intids, start=start,
+                                                      limit=batch_size)
+        total += removed
+        if start is None:
+            break
+        transaction_manager.get().note(
+            u'Removed dangling intids up to %r' % (start,))
+        transaction_manager.commit()
+    logger.info("Removed %d dangling intids from %r", total, storage)
+    return total
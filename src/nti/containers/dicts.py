@@ -10,14 +10,26 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import sys
+import six
 import copy
 import time
+import zlib
+import heapq
+import random
+import numbers
+import weakref
+import contextlib
 import collections
+from itertools import chain
+from itertools import islice
 
 import BTrees
 
 from persistent import Persistent
 
+import transaction
+
 from zope import interface
 
 from zc.queue import CompositeQueue
@@ -34,25 +46,150 @@ from nti.zodb.persistentproperty import PersistentPropertyHolder
 logger = __import__('logging').getLogger(__name__)
 
 
+class _DictViewMixin(object):
+    """
+    Lazy, indexable views of a :class:`Dict`. They are sized by the
+    dict's length counter and iterate the BTree directly, so nothing
+    is copied or activated until it's actually needed.
+    """
+
+    __slots__ = ()
+
+    def _value(self, key):
+        raise NotImplementedError()
+
+    def _keys(self):
+        # An indexable sequence of the keys, in view order
+        return self._mapping._data.keys()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            keys = self._keys()
+            return [self._value(keys[i]) for i in range(*index.indices(len(self)))]
+        return self._value(self._keys()[index])
+
+    def __reversed__(self):
+        keys = self._keys()
+        for i in range(len(self) - 1, -1, -1):
+            yield self._value(keys[i])
+
+    def range(self, min=None, max=None, excludemin=False, excludemax=False):  # pylint: disable=redefined-builtin
+        """
+        Iterate the part of the view whose keys are between *min* and
+        *max*, with the same arguments as :meth:`BTrees.OOBTree.OOBTree.keys`.
+        """
+        keys = self._mapping._data.keys(min, max,
+                                        excludemin=excludemin,
+                                        excludemax=excludemax)
+        return (self._value(key) for key in keys)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._mapping)
+
+
+class DictKeysView(_DictViewMixin, collections.KeysView):
+    """
+    The keys of a :class:`Dict`. Containment is a BTree lookup.
+    """
+
+    __slots__ = ()
+
+    def _value(self, key):
+        return key
+
+
+class DictValuesView(_DictViewMixin, collections.ValuesView):
+    """
+    The values of a :class:`Dict`.
+    """
+
+    __slots__ = ()
+
+    def _value(self, key):
+        return self._mapping[key]
+
+    def __iter__(self):
+        return iter(self._mapping.itervalues())
+
+
+class DictItemsView(_DictViewMixin, collections.ItemsView):
+    """
+    The items of a :class:`Dict`. Containment is a BTree lookup.
+    """
+
+    __slots__ = ()
+
+    def _value(self, key):
+        return (key, self._mapping[key])
+
+    def __iter__(self):
+        return iter(self._mapping.iteritems())
+
+
+class _OrderedDictViewMixin(object):
+    """
+    Views of an :class:`OrderedDict`, following its order.
+    """
+
+    __slots__ = ()
+
+    def _keys(self):
+        order = self._mapping._order
+        if isinstance(order, IndexedList):
+            return order
+        # A MinimalList only indexes by iterating, so copy it once
+        return list(order)
+
+    def range(self, *args, **kwargs):
+        raise TypeError("Ordered views don't support key ranges")
+
+
+class OrderedDictKeysView(_OrderedDictViewMixin, DictKeysView):
+    __slots__ = ()
+
+
+class OrderedDictValuesView(_OrderedDictViewMixin, DictValuesView):
+    __slots__ = ()
+
+
+class OrderedDictItemsView(_OrderedDictViewMixin, DictItemsView):
+    __slots__ = ()
+
+
+def _btree_factory(btree_type):
+    # A BTree class, or a module (e.g. ``BTrees.family64.IO``) that has one
+    return getattr(btree_type, 'BTree', btree_type)
+
+
 class Dict(Persistent):
     """
     A BTree-based dict-like persistent object that can be safely
     inherited from.
+
+    By default the data is kept in an :class:`BTrees.OOBTree.OOBTree`.
+    Maps whose keys or values are integers can pass the keyword
+    argument ``btree_type`` to use a more compact BTree: either a
+    BTree class or a BTree module such as ``BTrees.family64.IO`` (so
+    the name ``btree_type`` can't be used as an initial key).
     """
 
+    #: The default BTree class (or module).
+    btree_type = BTrees.OOBTree.OOBTree
+
     def __init__(self, *args, **kwargs):
-        self._data = BTrees.OOBTree.OOBTree()
+        btree_type = kwargs.pop('btree_type', None) or self.btree_type
+        self._data = _btree_factory(btree_type)()
         self._len = BTrees.Length.Length()
         if args or kwargs:
             self.update(*args, **kwargs)
 
     def __setitem__(self, key, value):
-        delta = 1
-        if key in self._data:
-            delta = 0
-        self._data[key] = value
-        if delta:
-            self._len.change(delta)
+        # insert only stores new keys, so adding a key (the common
+        # case) takes one lookup
+        if self._data.insert(key, value):
+            self._len.change(1)
+        else:
+            self._data[key] = value
 
     def __delitem__(self, key):
         self.pop(key)
@@ -63,6 +200,10 @@ class Dict(Persistent):
                 raise TypeError(
                     'update expected at most 1 arguments, got %d' %
                     (len(args),))
+        if self._can_update_in_bulk():
+            self._update_in_bulk(args[0] if args else (), kwargs)
+            return
+        if args:
             if getattr(args[0], 'keys', None):
                 for k in args[0].keys():
                     self[k] = args[0][k]
@@ -72,6 +213,66 @@ class Dict(Persistent):
         for k, v in kwargs.items():
             self[k] = v
 
+    #: A bulk update counts its new keys by intersecting with the
+    #: whole tree only if it has at least 1/this many items as the
+    #: tree; smaller updates look up each key.
+    _bulk_merge_factor = 16
+
+    def _can_update_in_bulk(self):
+        # The bulk path bypasses __setitem__, so it's only correct when
+        # that hasn't been overridden with more behaviour.
+        setitem = type(self).__setitem__
+        return getattr(setitem, '__func__', setitem) in _BULK_SAFE_SETITEMS
+
+    def _update_in_bulk(self, other, kwargs):
+        """
+        Store everything in *other* and *kwargs* with one
+        :meth:`BTrees.OOBTree.OOBTree.update`, computing the number
+        of new keys with one intersection and changing ``_len`` once.
+        """
+        data = self._data
+        tree_type = type(data)
+        if isinstance(other, Dict) and other._can_update_in_bulk():
+            # Its keys are stored as-is
+            other = other._data
+        if isinstance(other, tree_type) and not kwargs:
+            # Already sorted and unique; no need to copy it
+            incoming = other
+        else:
+            incoming = tree_type()
+            if getattr(other, 'keys', None) is None:
+                # BTree update needs a sequence of pairs
+                other = list(other)
+            elif not isinstance(other, tree_type):
+                other = [(k, other[k]) for k in other.keys()]
+            incoming.update(other)
+            incoming.update(kwargs)
+        if not incoming:
+            return 0
+        if len(incoming) * self._bulk_merge_factor >= self._len():
+            # Merging with the whole tree is cheaper than probing
+            module = sys.modules[tree_type.__module__]
+            added = len(incoming) - len(module.intersection(data, incoming))
+            data.update(incoming)
+        else:
+            # Few enough to look up one at a time; this doesn't touch
+            # the rest of a large tree
+            added = 0
+            for key, value in incoming.items():
+                if data.insert(key, value):
+                    added += 1
+                else:
+                    data[key] = value
+        if added:
+            self._len.change(added)
+        self._updated_in_bulk(len(incoming))
+        return added
+
+    def _updated_in_bulk(self, count):
+        """
+        Called after a bulk update stored *count* (non-zero) items.
+        """
+
     def setdefault(self, key, failobj=None):
         # we can't use BTree's setdefault because then we don't know to
         # increment _len
@@ -101,28 +302,39 @@ class Dict(Persistent):
     def __len__(self):
         return self._len()
 
+    #: If true, :meth:`keys`, :meth:`values` and :meth:`items` return
+    #: lists, as they used to, instead of lazy views.
+    legacy_list_views = False
+
+    _keys_view = DictKeysView
+    _values_view = DictValuesView
+    _items_view = DictItemsView
+
     def keys(self):
-        return list(self._data.keys())
+        if self.legacy_list_views:
+            return list(self.iterkeys())
+        return self._keys_view(self)
 
     def values(self):
-        return list(self._data.values())
+        if self.legacy_list_views:
+            return list(self.itervalues())
+        return self._values_view(self)
 
     def items(self):
-        return list(self._data.items())
+        if self.legacy_list_views:
+            return list(self.iteritems())
+        return self._items_view(self)
 
     def copy(self):
-        if self.__class__ is Dict:
-            return Dict(self._data)
-        _len = self._len
-        data = self._data
-        try:
-            self._len = BTrees.Length.Length()
-            self._data = BTrees.OOBTree.OOBTree()
-            c = copy.copy(self)
-        finally:
-            self._len = _len
-            self._data = data
-        c.update(self._data)
+        """
+        Return a shallow copy. The BTree is cloned directly (it's
+        already sorted, so this is close to the cost of copying its
+        buckets) and the length counter is copied by value; no
+        per-item ``__setitem__`` calls are made.
+        """
+        c = copy.copy(self)
+        c._data = type(self._data)(self._data)
+        c._len = BTrees.Length.Length(self._len())
         return c
 
     def __getitem__(self, key):
@@ -189,10 +401,263 @@ class MinimalList(CompositeQueue):
         raise ValueError('not in list')
 
 
+class _IndexedListLeaf(Persistent):
+    """
+    A leaf of an :class:`IndexedList`, holding the items themselves.
+    """
+
+    def __init__(self, items=()):
+        self.items = list(items)
+
+    def size(self):
+        return len(self.items)
+
+
+class _IndexedListBranch(Persistent):
+    """
+    An interior node of an :class:`IndexedList`, holding its children
+    and the number of items under each of them.
+    """
+
+    def __init__(self, children=()):
+        self.children = list(children)
+        self.counts = [child.size() for child in self.children]
+
+    def size(self):
+        return sum(self.counts)
+
+    def locate(self, index, inserting=False):
+        """
+        Find the child holding *index*, returning the child's position
+        and the index within the child.
+        """
+        counts = self.counts
+        last = len(counts) - 1
+        for i, count in enumerate(counts):
+            if index < count or (inserting and i == last):
+                return i, index
+            index -= count
+        raise IndexError(index)
+
+
+class IndexedList(Persistent):
+    """
+    A persistent list kept as a B-tree whose interior nodes record the
+    number of items below each child (an order-statistic tree).
+    Indexing, :meth:`insert` and removing by index (:meth:`pull`) are
+    O(log n); :meth:`replace` builds the tree bottom-up.
+
+    This has the same API as :class:`MinimalList`, which is still
+    what :func:`list_type` returns. :class:`OrderedDict` uses it only
+    when :attr:`OrderedDict.indexed_order` is set, or after
+    :meth:`OrderedDict.migrateOrder`. Unlike a
+    :class:`zc.queue.CompositeQueue`, concurrent changes always
+    conflict, because every change updates the counts on the path to
+    the root.
+    """
+
+    #: The most items a leaf holds before it is split.
+    _max_leaf_size = 64
+    #: The most children an interior node holds before it is split.
+    _max_branch_size = 32
+
+    def __init__(self, items=()):
+        self.replace(items)
+
+    # Building
+
+    def _build(self, items):
+        items = list(items)
+        step = self._max_leaf_size
+        nodes = [_IndexedListLeaf(items[i:i + step])
+                 for i in range(0, len(items), step)]
+        step = self._max_branch_size
+        while len(nodes) > 1:
+            nodes = [_IndexedListBranch(nodes[i:i + step])
+                     for i in range(0, len(nodes), step)]
+        return nodes[0] if nodes else _IndexedListLeaf()
+
+    def replace(self, items=()):
+        self._root = self._build(items or ())
+
+    def clear(self):
+        self._root = _IndexedListLeaf()
+
+    # Reading
+
+    def __len__(self):
+        return self._root.size()
+
+    def __bool__(self):
+        return bool(len(self))
+    __nonzero__ = __bool__
+
+    def _normalize(self, index, inserting=False):
+        size = len(self)
+        if index < 0:
+            index += size
+        if index < 0 or index > size or (index == size and not inserting):
+            raise IndexError(index)
+        return index
+
+    def _iter_from(self, start):
+        stack = []
+        node = self._root
+        while isinstance(node, _IndexedListBranch):
+            i, start = node.locate(start, inserting=True)
+            stack.append((node, i))
+            node = node.children[i]
+        while True:
+            for item in node.items[start:]:
+                yield item
+            start = 0
+            # Move to the first leaf of the next subtree
+            while stack and stack[-1][1] + 1 >= len(stack[-1][0].children):
+                stack.pop()
+            if not stack:
+                return
+            parent, i = stack.pop()
+            stack.append((parent, i + 1))
+            node = parent.children[i + 1]
+            while isinstance(node, _IndexedListBranch):
+                stack.append((node, 0))
+                node = node.children[0]
+
+    def __iter__(self):
+        return self._iter_from(0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return list(islice(self._iter_from(start), max(stop - start, 0)))
+            return [self[i] for i in range(start, stop, step)]
+        index = self._normalize(index)
+        node = self._root
+        while isinstance(node, _IndexedListBranch):
+            i, index = node.locate(index)
+            node = node.children[i]
+        return node.items[index]
+
+    # Writing
+
+    def __setitem__(self, index, item):
+        index = self._normalize(index)
+        node = self._root
+        while isinstance(node, _IndexedListBranch):
+            i, index = node.locate(index)
+            node = node.children[i]
+        node.items[index] = item
+        node._p_changed = True
+
+    def _split(self, node):
+        if isinstance(node, _IndexedListLeaf):
+            if len(node.items) <= self._max_leaf_size:
+                return None
+            half = len(node.items) // 2
+            sibling = _IndexedListLeaf(node.items[half:])
+            node.items = node.items[:half]
+            return sibling
+        if len(node.children) <= self._max_branch_size:
+            return None
+        half = len(node.children) // 2
+        sibling = _IndexedListBranch(node.children[half:])
+        node.children = node.children[:half]
+        node.counts = node.counts[:half]
+        return sibling
+
+    def _insert(self, node, index, item):
+        # Returns the new right sibling if *node* had to be split
+        if isinstance(node, _IndexedListLeaf):
+            node.items.insert(index, item)
+            node._p_changed = True
+            return self._split(node)
+        i, index = node.locate(index, inserting=True)
+        child = node.children[i]
+        sibling = self._insert(child, index, item)
+        node.counts[i] += 1
+        if sibling is not None:
+            node.counts[i] = child.size()
+            node.children.insert(i + 1, sibling)
+            node.counts.insert(i + 1, sibling.size())
+        node._p_changed = True
+        return self._split(node)
+
+    def insert(self, index, item):
+        if index < 0:
+            index = max(index + len(self), 0)
+        index = min(index, len(self))
+        root = self._root
+        sibling = self._insert(root, index, item)
+        if sibling is not None:
+            self._root = _IndexedListBranch((root, sibling))
+
+    def append(self, item):
+        self.insert(len(self), item)
+    put = append
+
+    def extend(self, items=()):
+        if not self:
+            self.replace(items)
+        else:
+            for item in items or ():
+                self.append(item)
+
+    def _pull(self, node, index):
+        if isinstance(node, _IndexedListLeaf):
+            node._p_changed = True
+            return node.items.pop(index)
+        i, index = node.locate(index)
+        item = self._pull(node.children[i], index)
+        node.counts[i] -= 1
+        if not node.counts[i]:
+            del node.children[i]
+            del node.counts[i]
+        node._p_changed = True
+        return item
+
+    def pull(self, index=0):
+        index = self._normalize(index)
+        item = self._pull(self._root, index)
+        # Nodes aren't rebalanced; just drop levels that are no longer needed
+        root = self._root
+        while isinstance(root, _IndexedListBranch) and len(root.children) <= 1:
+            root = root.children[0] if root.children else _IndexedListLeaf()
+        if root is not self._root:
+            self._root = root
+        return item
+
+    def __delitem__(self, index):
+        self.pull(index)
+
+    def index(self, item):
+        for i, v in enumerate(self):
+            if item == v:
+                return i
+        raise ValueError('not in list')
+
+    def remove(self, item):
+        return self.pull(self.index(item))
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, list(self))
+
+
 def list_type():
     return MinimalList()
 
 
+def migrate_list(old):
+    """
+    Return an :class:`IndexedList` with the items of *old*, a
+    :class:`MinimalList` or other :class:`zc.queue.CompositeQueue`.
+    Anything else is returned unchanged.
+    """
+    if isinstance(old, CompositeQueue):
+        return IndexedList(old)
+    return old
+
+
 class OrderedDict(Dict):
     """
     An ordered BTree-based dict-like persistent object that can be safely
@@ -202,28 +667,44 @@ class OrderedDict(Dict):
     :class:`zope.container.ordered.OrderedContainer`
     """
 
+    #: If true, new instances keep their order in an
+    #: :class:`IndexedList` instead of a :class:`MinimalList`, making
+    #: indexing the order (and so the views) O(log n) instead of
+    #: O(n). The trade-off is concurrency: a :class:`MinimalList`
+    #: merges concurrent appends by conflict resolution, while every
+    #: append to an :class:`IndexedList` rewrites the counts on the
+    #: path to its root, so concurrent inserts conflict.
+    indexed_order = False
+
     def __init__(self, *args, **kwargs):
-        self._order = list_type()
+        self._order = IndexedList() if self.indexed_order else list_type()
         super(OrderedDict, self).__init__(*args, **kwargs)
 
-    def keys(self):
-        return list(self._order)
+    _keys_view = OrderedDictKeysView
+    _values_view = OrderedDictValuesView
+    _items_view = OrderedDictItemsView
 
     def __iter__(self):
         return iter(self._order)
 
-    def values(self):
-        return [self._data[key] for key in self._order]
-
-    def items(self):
-        return [(key, self._data[key]) for key in self._order]
-
     def __setitem__(self, key, value):
         if key not in self._data:
             self._order.append(key)
             self._len.change(1)
         self._data[key] = value
 
+    def migrateOrder(self):
+        """
+        Convert an order kept in a :class:`MinimalList` to an
+        :class:`IndexedList` (see :attr:`indexed_order` for the
+        trade-off). Returns whether anything changed.
+        """
+        order = migrate_list(self._order)
+        if order is self._order:
+            return False
+        self._order = order
+        return True
+
     def updateOrder(self, order):
         order = list(order)
 
@@ -245,21 +726,9 @@ class OrderedDict(Dict):
         self._order.clear()
 
     def copy(self):
-        if self.__class__ is OrderedDict:
-            return OrderedDict(self)
-        _len = self._len
-        data = self._data
-        order = self._order
-        try:
-            self._order = list_type()
-            self._len = BTrees.Length.Length()
-            self._data = BTrees.OOBTree.OOBTree()
-            c = copy.copy(self)
-        finally:
-            self._len = _len
-            self._data = data
-            self._order = order
-        c.update(self)
+        c = super(OrderedDict, self).copy()
+        c._order = type(self._order)()
+        c._order.extend(self._order)
         return c
 
     def iteritems(self):
@@ -285,6 +754,587 @@ class OrderedDict(Dict):
         return res
 
 
+class _BTreeOrderedDictViewMixin(_OrderedDictViewMixin):
+
+    __slots__ = ()
+
+    def _keys(self):
+        # Lazily indexable, in order
+        return self._mapping._order.values()
+
+
+class BTreeOrderedDictKeysView(_BTreeOrderedDictViewMixin, DictKeysView):
+    __slots__ = ()
+
+
+class BTreeOrderedDictValuesView(_BTreeOrderedDictViewMixin, DictValuesView):
+    __slots__ = ()
+
+
+class BTreeOrderedDictItemsView(_BTreeOrderedDictViewMixin, DictItemsView):
+    __slots__ = ()
+
+
+class BTreeOrderedDict(Dict):
+    """
+    An ordered BTree-based dict-like persistent object that can be safely
+    inherited from.
+
+    Unlike :class:`OrderedDict`, the order is kept in a BTree mapping
+    sparse integer positions to keys (plus the reverse mapping), so
+    :meth:`pop`, :meth:`move_to_end` and :meth:`insert_before` are
+    O(log n). Appended keys get a randomly jittered position past the
+    end, so concurrent appends usually land on distinct positions and
+    their BTree changes can be merged by conflict resolution.
+    """
+
+    #: The distance between the positions of consecutively appended keys.
+    _position_gap = 1 << 20
+
+    _keys_view = BTreeOrderedDictKeysView
+    _values_view = BTreeOrderedDictValuesView
+    _items_view = BTreeOrderedDictItemsView
+
+    def __init__(self, *args, **kwargs):
+        # position -> key and key -> position
+        self._order = BTrees.family64.IO.BTree()
+        self._positions = BTrees.family64.OI.BTree()
+        super(BTreeOrderedDict, self).__init__(*args, **kwargs)
+
+    def _next_position(self, last=True):
+        gap = self._position_gap
+        jitter = random.randint(0, gap // 2)
+        order = self._order
+        if not order:
+            return jitter
+        if last:
+            return order.maxKey() + gap + jitter
+        return order.minKey() - gap - jitter
+
+    def _place(self, key, position):
+        self._order[position] = key
+        self._positions[key] = position
+
+    def _unplace(self, key):
+        del self._order[self._positions.pop(key)]
+
+    def _renumber(self, keys):
+        self._order.clear()
+        self._positions.clear()
+        for i, key in enumerate(keys):
+            self._place(key, i * self._position_gap)
+
+    def __setitem__(self, key, value):
+        if key not in self._data:
+            self._place(key, self._next_position())
+            self._len.change(1)
+        self._data[key] = value
+
+    def insert_before(self, before, key, value):
+        """
+        Set *key* to *value* and put it immediately before the
+        existing key *before*, moving *key* if it already exists.
+        """
+        if before not in self._data:
+            raise KeyError(before)
+        if key == before:
+            self._data[key] = value
+            return
+        if key in self._data:
+            self._unplace(key)
+        else:
+            self._len.change(1)
+        self._data[key] = value
+        position = self._positions[before]
+        try:
+            previous = self._order.maxKey(position - 1)
+        except ValueError:
+            # before is first
+            self._place(key, position - self._position_gap)
+            return
+        middle = (previous + position) // 2
+        if middle == previous:
+            # No room left between them; spread everything out again
+            keys = list(self._order.values())
+            keys.insert(keys.index(before), key)
+            self._renumber(keys)
+        else:
+            self._place(key, middle)
+
+    def move_to_end(self, key, last=True):
+        """
+        Move the existing *key* to the end (or, if *last* is false, the
+        beginning) of the order.
+        """
+        if key not in self._data:
+            raise KeyError(key)
+        self._unplace(key)
+        self._place(key, self._next_position(last))
+
+    def __iter__(self):
+        return iter(self._order.values())
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        data = self._data
+        return ((key, data[key]) for key in self._order.values())
+
+    def itervalues(self):
+        data = self._data
+        return (data[key] for key in self._order.values())
+
+    def updateOrder(self, order):
+        order = list(order)
+
+        if len(order) != len(self._data):
+            raise ValueError("Incompatible key set.")
+
+        order_set = set(order)
+
+        if len(order) != len(order_set):
+            raise ValueError("Duplicate keys in order.")
+
+        if [key for key in order_set if key not in self._data]:
+            raise ValueError("Incompatible key set.")
+
+        self._renumber(order)
+
+    def pop(self, key, *args):
+        try:
+            res = self._data.pop(key)
+        except KeyError:
+            if args:
+                res = args[0]
+            else:
+                raise
+        else:
+            self._len.change(-1)
+            self._unplace(key)
+        return res
+
+    def popitem(self, last=False):
+        """
+        Remove and return the first (or, if *last* is true, the last)
+        item in the order.
+        """
+        order = self._order
+        if not order:
+            raise KeyError('container is empty')
+        key = order[order.maxKey() if last else order.minKey()]
+        return (key, self.pop(key))
+
+    def clear(self):
+        super(BTreeOrderedDict, self).clear()
+        self._order.clear()
+        self._positions.clear()
+
+    def copy(self):
+        c = super(BTreeOrderedDict, self).copy()
+        c._order = type(self._order)(self._order)
+        c._positions = type(self._positions)(self._positions)
+        return c
+
+
+class BoundedDict(Dict):
+    """
+    A :class:`Dict` that holds at most about :attr:`maxsize` items,
+    evicting the least recently written (or, with ``lru=True``, the
+    least recently used) ones.
+
+    Each key has a stamp (the time, with random low bits) kept in an
+    index ordered by stamp, so finding the oldest entries is O(log n).
+    Eviction is lazy and approximate: each write evicts at most
+    :attr:`_evictions_per_write` entries from among the oldest, so a
+    dict that has just had its :attr:`maxsize` lowered shrinks
+    gradually. Because concurrent writers pick distinct stamps (and
+    usually evict different entries), their index changes are merged
+    by BTree conflict resolution.
+
+    Both ``maxsize`` and ``lru`` can be passed as keyword arguments
+    at construction or set as class attributes.
+    """
+
+    #: The number of items to keep.
+    maxsize = 1000
+
+    #: If true, reading an item also refreshes it (LRU). Note that this
+    #: makes reads write to the database.
+    lru = False
+
+    #: The most entries evicted by a single write.
+    _evictions_per_write = 2
+
+    #: Evicted entries are chosen from this many of the oldest.
+    _eviction_window = 16
+
+    def __init__(self, *args, **kwargs):
+        for name in ('maxsize', 'lru'):
+            if name in kwargs:
+                setattr(self, name, kwargs.pop(name))
+        # stamp -> key and key -> stamp
+        self._stamps = BTrees.family64.IO.BTree()
+        self._key_stamps = BTrees.family64.OI.BTree()
+        super(BoundedDict, self).__init__(*args, **kwargs)
+
+    def _new_stamp(self):
+        # Microseconds with 10 random low bits still fit in 63 bits
+        stamp = (int(time.time() * 1000000) << 10) | random.getrandbits(10)
+        while stamp in self._stamps:
+            stamp += 1
+        return stamp
+
+    def _unstamp(self, key):
+        stamp = self._key_stamps.pop(key, None)
+        if stamp is not None:
+            del self._stamps[stamp]
+
+    def _stamp(self, key):
+        self._unstamp(key)
+        stamp = self._new_stamp()
+        self._stamps[stamp] = key
+        self._key_stamps[key] = stamp
+
+    def __setitem__(self, key, value):
+        super(BoundedDict, self).__setitem__(key, value)
+        self._stamp(key)
+        self.evict(self._evictions_per_write)
+
+    def __getitem__(self, key):
+        result = self._data[key]
+        if self.lru:
+            self._stamp(key)
+        return result
+
+    def get(self, key, failobj=None):
+        try:
+            return self[key]
+        except KeyError:
+            return failobj
+
+    def pop(self, key, *args):
+        if key in self._data:
+            self._unstamp(key)
+        return super(BoundedDict, self).pop(key, *args)
+
+    def popitem(self):
+        """
+        Remove and return the oldest item.
+        """
+        try:
+            key = self._stamps[self._stamps.minKey()]
+        except ValueError:
+            raise KeyError('container is empty')
+        return (key, self.pop(key))
+
+    def evict(self, limit=None):
+        """
+        Remove old items until there are no more than :attr:`maxsize`,
+        but no more than *limit* of them. Returns the number removed.
+
+        Each item removed is chosen at random from the
+        :attr:`_eviction_window` oldest, so that concurrent writers
+        usually evict different items and don't conflict. The newest
+        item (usually the one just written) is never chosen unless
+        it's the only one.
+        """
+        excess = max(len(self) - self.maxsize, 0)
+        if limit is not None:
+            excess = min(excess, limit)
+        for _ in range(excess):
+            window = max(min(self._eviction_window, len(self._stamps) - 1), 1)
+            oldest = list(islice(self._stamps.values(), window))
+            self.pop(random.choice(oldest))
+        return excess
+
+    def clear(self):
+        super(BoundedDict, self).clear()
+        self._stamps.clear()
+        self._key_stamps.clear()
+
+    def copy(self):
+        c = super(BoundedDict, self).copy()
+        c._stamps = type(self._stamps)(self._stamps)
+        c._key_stamps = type(self._key_stamps)(self._key_stamps)
+        return c
+
+
+class _ShardedDictViewMixin(object):
+
+    __slots__ = ()
+
+    def _keys(self):
+        return list(self._mapping)
+
+    def range(self, min=None, max=None, excludemin=False, excludemax=False):  # pylint: disable=redefined-builtin
+        keys = self._mapping._iter_shards(lambda shard: shard.keys(min, max,
+                                                                   excludemin=excludemin,
+                                                                   excludemax=excludemax))
+        return (self._value(key) for key in keys)
+
+
+class ShardedDictKeysView(_ShardedDictViewMixin, DictKeysView):
+    __slots__ = ()
+
+
+class ShardedDictValuesView(_ShardedDictViewMixin, DictValuesView):
+    __slots__ = ()
+
+
+class ShardedDictItemsView(_ShardedDictViewMixin, DictItemsView):
+    __slots__ = ()
+
+
+def _stable_hash(key):
+    if isinstance(key, six.integer_types):
+        return key
+    if isinstance(key, numbers.Number):
+        # Keys that compare equal must be in the same shard, so
+        # integral numbers (1.0, Decimal(1)) shard like the int
+        try:
+            if key == int(key):
+                return int(key)
+        except (TypeError, ValueError, OverflowError):
+            # complex, nan, inf
+            pass
+    if not isinstance(key, bytes):
+        key = six.text_type(key).encode('utf-8')
+    # crc32 (unlike hash()) is stable across processes
+    return zlib.crc32(key) & 0xffffffff
+
+
+class ShardedDict(Dict):
+    """
+    A :class:`Dict` whose keys are partitioned by a stable hash across
+    several BTrees, each with its own length counter, so that
+    concurrent writers to a hot map rarely touch the same BTree root,
+    bucket or counter. ``len()`` is O(number of shards).
+
+    The number of shards is :attr:`shard_count`, which can be passed
+    as a keyword argument at construction (like ``btree_type``) and
+    can't be changed afterwards. Iteration goes shard by shard unless
+    :attr:`ordered` is true, in which case the shards are merged to
+    give the keys in sorted order.
+    """
+
+    #: How many BTrees to spread the keys over.
+    shard_count = 16
+
+    #: Whether to iterate in key order (a k-way merge of the shards).
+    ordered = False
+
+    _keys_view = ShardedDictKeysView
+    _values_view = ShardedDictValuesView
+    _items_view = ShardedDictItemsView
+
+    def __init__(self, *args, **kwargs):  # pylint: disable=super-init-not-called
+        for name in ('shard_count', 'ordered'):
+            if name in kwargs:
+                setattr(self, name, kwargs.pop(name))
+        factory = _btree_factory(kwargs.pop('btree_type', None) or self.btree_type)
+        # Tuples are part of our own state, which therefore doesn't
+        # change when the shards do.
+        self._shards = tuple(factory() for _ in range(self.shard_count))
+        self._lengths = tuple(BTrees.Length.Length() for _ in range(self.shard_count))
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def _shard_index(self, key):
+        return _stable_hash(key) % len(self._shards)
+
+    def _shard(self, key):
+        return self._shards[self._shard_index(key)]
+
+    def _iter_shards(self, iterator):
+        """
+        Iterate through ``iterator(shard)`` for every shard, in key order
+        if :attr:`ordered`.
+        """
+        iterators = [iterator(shard) for shard in self._shards]
+        if self.ordered:
+            return heapq.merge(*iterators)
+        return chain.from_iterable(iterators)
+
+    def __setitem__(self, key, value):
+        i = self._shard_index(key)
+        if self._shards[i].insert(key, value):
+            self._lengths[i].change(1)
+        else:
+            self._shards[i][key] = value
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def get(self, key, failobj=None):
+        return self._shard(key).get(key, failobj)
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def has_key(self, key):
+        return key in self
+
+    def setdefault(self, key, failobj=None):
+        i = self._shard_index(key)
+        if self._shards[i].insert(key, failobj):
+            self._lengths[i].change(1)
+            return failobj
+        return self._shards[i][key]
+
+    def pop(self, key, *args):
+        i = self._shard_index(key)
+        try:
+            res = self._shards[i].pop(key)
+        except KeyError:
+            if args:
+                return args[0]
+            raise
+        self._lengths[i].change(-1)
+        return res
+
+    def popitem(self):
+        for shard in self._shards:
+            if shard:
+                key = shard.minKey()
+                return (key, self.pop(key))
+        raise KeyError('container is empty')
+
+    def clear(self):
+        for shard, length in zip(self._shards, self._lengths):
+            shard.clear()
+            length.set(0)
+
+    def __len__(self):
+        return sum(length() for length in self._lengths)
+
+    def __iter__(self):
+        return self._iter_shards(lambda shard: shard.keys())
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        return self._iter_shards(lambda shard: shard.items())
+
+    def itervalues(self):
+        return (v for _, v in self.iteritems())
+
+    def copy(self):
+        c = copy.copy(self)
+        c._shards = tuple(type(shard)(shard) for shard in self._shards)
+        c._lengths = tuple(BTrees.Length.Length(length()) for length in self._lengths)
+        return c
+
+
+class CounterDict(Dict):
+    """
+    A :class:`Dict` of integer counters that merge under concurrent
+    changes.
+
+    Each value is stored as a :class:`BTrees.Length.Length`, so
+    concurrent :meth:`increment` calls, to the same key or to
+    different keys, are resolved by summing their deltas instead of
+    conflicting. (Only the first increment of a key adds it to the
+    BTree; two transactions that both create the same key still
+    conflict.) Reading a key returns its current integer value, and
+    missing keys count as 0 for :meth:`get` and :meth:`increment`.
+    """
+
+    def __getitem__(self, key):
+        return self._data[key]()
+
+    def get(self, key, failobj=0):
+        counter = self._data.get(key)
+        return failobj if counter is None else counter()
+
+    def __setitem__(self, key, value):
+        # Setting (unlike incrementing) doesn't merge
+        counter = self._data.get(key)
+        if counter is None:
+            self._data[key] = BTrees.Length.Length(value)
+            self._len.change(1)
+        else:
+            counter.set(value)
+
+    def setdefault(self, key, failobj=0):
+        counter = self._data.get(key)
+        if counter is None:
+            self[key] = failobj
+            return failobj
+        return counter()
+
+    def increment(self, key, delta=1):
+        """
+        Add *delta* to the counter for *key* (creating it at 0 if
+        needed) and return the new value.
+        """
+        counter = self._data.get(key)
+        if counter is None:
+            counter = BTrees.Length.Length()
+            self._data[key] = counter
+            self._len.change(1)
+        counter.change(delta)
+        return counter()
+
+    def increment_many(self, deltas):
+        """
+        Apply :meth:`increment` for each key and delta in the mapping
+        (or sequence of pairs) *deltas*.
+        """
+        if getattr(deltas, 'items', None) is not None:
+            deltas = deltas.items()
+        for key, delta in deltas:
+            self.increment(key, delta)
+
+    def pop(self, key, *args):
+        try:
+            counter = self._data.pop(key)
+        except KeyError:
+            if args:
+                return args[0]
+            raise
+        self._len.change(-1)
+        return counter()
+
+    def iteritems(self):
+        return ((k, counter()) for k, counter in self._data.iteritems())
+
+    def itervalues(self):
+        return (counter() for counter in self._data.itervalues())
+
+    def copy(self):
+        c = copy.copy(self)
+        c._data = type(self._data)([(k, BTrees.Length.Length(v()))
+                                    for k, v in self._data.iteritems()])
+        c._len = BTrees.Length.Length(self._len())
+        return c
+
+
+class _LastModBatch(object):
+    """
+    The pending ``lastModified`` update of a batching
+    :class:`LastModifiedDict`.
+    """
+
+    __slots__ = ('txn', 'changed', 't')
+
+    def __init__(self, txn=None):
+        #: A weak reference to the transaction this batch lasts for,
+        #: or None for a :meth:`LastModifiedDict.batched` block.
+        self.txn = txn
+        self.changed = False
+        #: The greatest time explicitly given to ``updateLastMod``.
+        self.t = None
+
+
+#: The active :class:`_LastModBatch` of each batching
+#: :class:`LastModifiedDict`, by ``id()``. This can't be a volatile
+#: attribute: the pickle cache may ghost the object in the middle of a
+#: batch (e.g., at a savepoint), which would drop it. A ``batched``
+#: block removes its entry on exit; a ``batchUntilCommit`` entry is
+#: removed when the transaction commits or goes away.
+_lastModBatches = {}
+
+
 @interface.implementer(ILastModified)
 class LastModifiedDict(PersistentPropertyHolder,
                        ZC_Dict):
@@ -302,10 +1352,84 @@ class LastModifiedDict(PersistentPropertyHolder,
         self.createdTime = time.time()
         super(LastModifiedDict, self).__init__(*args, **kwargs)
 
+    def _current_lastModBatch(self):
+        batch = _lastModBatches.get(id(self))
+        if batch is not None and batch.txn is not None \
+                and batch.txn() is not self._transaction_manager().get():
+            # Left over from a transaction that ended without committing
+            self._discard_lastModBatch(batch)
+            batch = None
+        return batch
+
+    def _discard_lastModBatch(self, batch):
+        if _lastModBatches.get(id(self)) is batch:
+            del _lastModBatches[id(self)]
+
+    def _transaction_manager(self):
+        jar = self._p_jar
+        if jar is not None and getattr(jar, 'transaction_manager', None) is not None:
+            return jar.transaction_manager
+        return transaction.manager
+
     def updateLastMod(self, t=None):
+        batch = self._current_lastModBatch()
+        if batch is not None:
+            batch.changed = True
+            if t is not None and (batch.t is None or t > batch.t):
+                batch.t = t
+            return self.lastModified
         self.lastModified = t if t is not None and t > self.lastModified else time.time()
         return self.lastModified
 
+    def _finish_lastModBatch(self, batch):
+        if batch is None:
+            return
+        self._discard_lastModBatch(batch)
+        if batch.changed:
+            self.updateLastMod(batch.t)
+
+    @contextlib.contextmanager
+    def batched(self):
+        """
+        A context manager that defers the ``lastModified`` update done
+        by each mutation: one update is made when the block exits (if
+        anything changed). Inside the block, ``lastModified`` keeps the
+        value it had when the block started. Blocks may be nested; only
+        the outermost one updates.
+        """
+        if self._current_lastModBatch() is not None:
+            # Already batching; the outer batch does the update
+            yield self
+            return
+        batch = _lastModBatches[id(self)] = _LastModBatch()
+        try:
+            yield self
+        finally:
+            self._finish_lastModBatch(batch)
+
+    def batchUntilCommit(self):
+        """
+        Like :meth:`batched`, but for the rest of the current
+        transaction: the single ``lastModified`` update is made just
+        before it commits. If the transaction aborts instead, nothing
+        is updated. Calling this again in the same transaction has no
+        further effect.
+        """
+        if self._current_lastModBatch() is not None:
+            return
+        txn = self._transaction_manager().get()
+        batch = _LastModBatch()
+        key = id(self)
+
+        def forget(_):
+            # The transaction aborted and is gone. (While it's alive,
+            # its hook keeps this object, and so its id, alive.)
+            if _lastModBatches.get(key) is batch:
+                del _lastModBatches[key]
+        batch.txn = weakref.ref(txn, forget)
+        _lastModBatches[key] = batch
+        txn.addBeforeCommitHook(self._finish_lastModBatch, (batch,))
+
     def updateLastModIfGreater(self, t):
         """
         Only if the given time is (not None and) greater than this object's 
@@ -339,6 +1463,25 @@ class LastModifiedDict(PersistentPropertyHolder,
         super(LastModifiedDict, self).__delitem__(key)
         self.updateLastMod()
 
+    def copy(self):
+        c = super(LastModifiedDict, self).copy()
+        # Don't share our lastModified holder. As when the items were
+        # copied one at a time, a non-empty copy was modified now.
+        c.__dict__.pop('_lastModified', None)
+        if len(c):
+            c.updateLastMod()
+        return c
+
+    def _updated_in_bulk(self, count):
+        self.updateLastMod()
+
+
+#: The ``__setitem__`` implementations that :meth:`Dict.update` can
+#: safely bypass.
+_BULK_SAFE_SETITEMS = frozenset(getattr(f, '__func__', f)
+                                for f in (Dict.__setitem__,
+                                          LastModifiedDict.__setitem__))
+
 
 class CaseInsensitiveLastModifiedDict(LastModifiedDict):
     """
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import interface
+
+from zope.container.contained import ContainerModifiedEvent
+
+from zope.container.interfaces import IContainerModifiedEvent
+
+
+class IContainerContentsChangedEvent(IContainerModifiedEvent):
+    """
+    A container was modified by one operation that added, removed or
+    modified any number of its items, which are identified by name.
+
+    Because this extends :class:`zope.container.interfaces.IContainerModifiedEvent`,
+    subscribers to that event (such as the ones that maintain
+    ``lastModified``) continue to work. Containers whose
+    ``aggregate_events`` attribute is true send only this event,
+    instead of an added or removed event for each object, so that
+    subscribers such as indexes can process the names in bulk.
+    """
+
+    added = interface.Attribute("A tuple of the names added, in sorted order.")
+
+    removed = interface.Attribute("A tuple of the names removed.")
+
+    modified = interface.Attribute("A tuple of the names whose objects were modified.")
+
+
+@interface.implementer(IContainerContentsChangedEvent)
+class ContainerContentsChangedEvent(ContainerModifiedEvent):
+
+    def __init__(self, obj, added=(), removed=(), modified=()):
+        super(ContainerContentsChangedEvent, self).__init__(obj)
+        self.added = tuple(added)
+        self.removed = tuple(removed)
+        self.modified = tuple(modified)
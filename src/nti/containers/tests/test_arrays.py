@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import unittest
+
+import numpy
+
+from nti.containers.arrays import export_intids
+
+from nti.containers.datastructures import IntidContainedStorage
+from nti.containers.datastructures import InternedIntidContainedStorage
+
+from nti.containers.tests import SharedConfiguringTestLayer
+
+
+class TestArrays(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def _storage(self, factory=IntidContainedStorage):
+        storage = factory()
+        # 'big' is promoted to a TreeSet, the others stay inline
+        storage._add_intids_to_container(storage._container_key('big', True),
+                                         range(0, 40, 2))
+        storage._add_intids_to_container(storage._container_key('small', True),
+                                         (2, 3, 4, 5))
+        storage._add_intids_to_container(storage._container_key('other', True),
+                                         (5, 7))
+        return storage
+
+    def test_export(self):
+        for factory in IntidContainedStorage, InternedIntidContainedStorage:
+            matrix = export_intids(self._storage(factory),
+                                   ('big', 'small', 'other', 'missing'))
+            assert_that(matrix, has_length(4))
+            assert_that(matrix.indices.dtype, is_(numpy.dtype(numpy.int64)))
+            assert_that(matrix.sizes().tolist(), is_([20, 4, 2, 0]))
+            assert_that(matrix.row('small').tolist(), is_([2, 3, 4, 5]))
+            assert_that(matrix.row('missing').tolist(), is_([]))
+
+            assert_that(matrix.intersection_count('big', 'small'), is_(2))
+            assert_that(matrix.intersection_count('small', 'other'), is_(1))
+            assert_that(matrix.intersection_count('big', 'other'), is_(0))
+
+            expected = [[20, 2, 0, 0],
+                        [2, 4, 1, 0],
+                        [0, 1, 2, 0],
+                        [0, 0, 0, 0]]
+            for chunk_size in (1, 3, 1 << 20):
+                counts = matrix.intersection_counts(chunk_size=chunk_size)
+                assert_that(counts.tolist(), is_(expected))
+
+    def test_export_all(self):
+        storage = self._storage()
+        matrix = export_intids(storage)
+        assert_that(sorted(matrix.containerIds),
+                    is_(['big', 'other', 'small']))
+
+        matrix = export_intids(IntidContainedStorage())
+        assert_that(matrix, has_length(0))
+        assert_that(matrix.indptr.tolist(), is_([0]))
+        assert_that(matrix.intersection_counts().tolist(), is_([]))
@@ -10,6 +10,7 @@ from __future__ import absolute_import
 from hamcrest import is_
 from hamcrest import none
 from hamcrest import is_not
+from hamcrest import has_key
 from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import has_property
@@ -28,6 +29,9 @@ import unittest
 
 import BTrees
 
+import transaction
+
+from Acquisition import aq_base
 from Acquisition import Implicit
 
 from ExtensionClass import Base
@@ -41,14 +45,27 @@ from zope.component.eventtesting import clearEvents
 from zope.container.contained import Contained as ZContained
 
 from zope.container.interfaces import INameChooser
+from zope.container.interfaces import IContainerModifiedEvent
 
 from zope.dottedname import resolve as dottedname
 
+from zope.interface.declarations import Provides
+
 from zope.location.interfaces import ILocation
 from zope.location.interfaces import IContained
 
+from ZODB import DB
+
+from ZODB.interfaces import IBroken
+
 from nti.base.interfaces import ILastModified
 
+from nti.containers.contained import no_ownership_setitem
+from nti.containers.contained import no_ownership_setitems
+from nti.containers.contained import remove_contained_declarations
+
+from nti.containers.interfaces import IContainerContentsChangedEvent
+
 from nti.containers.containers import _IdGenerationMixin
 from nti.containers.containers import _CaseInsensitiveKey
 from nti.containers.containers import _CheckObjectOnSetMixin
@@ -61,6 +78,7 @@ from nti.containers.containers import EventlessLastModifiedBTreeContainer
 from nti.containers.containers import CaseSensitiveLastModifiedBTreeFolder
 from nti.containers.containers import NOOwnershipLastModifiedBTreeContainer
 from nti.containers.containers import CaseInsensitiveLastModifiedBTreeContainer
+from nti.containers.containers import CaseInsensitiveCheckingLastModifiedBTreeContainer
 
 from nti.dublincore.datastructures import CreatedModDateTrackingObject
 
@@ -76,6 +94,21 @@ class Contained(CreatedModDateTrackingObject, ZContained):
     pass
 
 
+@interface.implementer(ILocation)
+class Location(object):
+    __parent__ = None
+    __name__ = None
+
+
+@interface.implementer(IContained)
+class ContainedLocation(Location):
+    pass
+
+
+class IOther(interface.Interface): # pylint: disable=inherit-non-class
+    pass
+
+
 class TestContainers(unittest.TestCase):
 
     layer = SharedConfiguringTestLayer
@@ -313,6 +346,41 @@ class TestContainers(unittest.TestCase):
         assert_that(c.pop('key', None), is_(value))
         assert_that(c.pop('key', None), is_(none()))
 
+    def test_eventless_container_bulk(self):
+        # Objects owned by another container keep their location
+        owner = LastModifiedBTreeContainer()
+        owned = owner['owned'] = Contained()
+        other = object()
+        c = EventlessLastModifiedBTreeContainer()
+        clearEvents()
+
+        assert_that(c.setitems({u'b': owned, u'a': other}), is_(2))
+        assert_that(c.setitems([(u'a', other)]), is_(0))
+        assert_that(c[u'b'], is_(same_instance(owned)))
+        assert_that(owned.__parent__, is_(same_instance(owner)))
+        assert_that(owned.__name__, is_(u'owned'))
+        assert_that(c, has_length(2))
+
+        # Everything is checked before anything is stored
+        for items in ([(u'c', other), (u'c', owned)],
+                      [(u'c', other), (u'a', owned)]):
+            with self.assertRaises(KeyError):
+                c.setitems(items)
+        with self.assertRaises(TypeError):
+            c.setitems([(u'c', other), (u'd', None)])
+        assert_that(c, has_length(2))
+
+        with self.assertRaises(KeyError):
+            c.delitems([u'a', u'missing'])
+        assert_that(c, has_length(2))
+
+        c.aggregate_events = True
+        c.clear()
+        assert_that(c, has_length(0))
+        assert_that(owned.__parent__, is_(same_instance(owner)))
+        assert_that(owned.__name__, is_(u'owned'))
+        assert_that(getEvents(), has_length(0))
+
     def test_noownership_container(self):
 
         marker = object()
@@ -419,6 +487,232 @@ class TestContainers(unittest.TestCase):
             del c['key']
         module.__dict__['fixing_up'] = False
 
+    def test_noownership_setitems(self):
+        c = NOOwnershipLastModifiedBTreeContainer()
+        existing = Contained()
+        c['b'] = existing
+        c.lastModified = 0
+        clearEvents()
+
+        a, d = Contained(), Contained()
+        # Checked before anything is stored
+        for bad in ({u'a': a, None: d},
+                    [(u'a', a), (u'a', d)],
+                    {u'a': a, u'b': d}):
+            with self.assertRaises((TypeError, KeyError)):
+                c.setitems(bad)
+        with self.assertRaises(ValueError):
+            c.setitems([(u'a', a), (u'', d)])
+        assert_that(c, has_length(1))
+        assert_that(getEvents(), has_length(0))
+
+        stored = []
+        count = no_ownership_setitems(c,
+                                      lambda k, v: stored.append(k) or c._setitemf(k, v),
+                                      [(u'd', d), (b'a', a), (u'a', a), (u'b', existing)])
+        assert_that(count, is_(2))
+        # In order, and owned by someone else
+        assert_that(stored, is_([u'a', u'd']))
+        assert_that(c, has_length(3))
+        assert_that(a, has_property('__name__', u'a'))
+        assert_that(a, has_property('__parent__', none()))
+        # Two added events, one modified event
+        assert_that(getEvents(), has_length(3))
+        assert_that(getEvents(IContainerModifiedEvent), has_length(1))
+        assert_that(c.lastModified, is_(greater_than(0)))
+
+        clearEvents()
+        assert_that(c.setitems({u'e': Contained()}, event=False), is_(1))
+        assert_that(getEvents(), has_length(1))
+        assert_that(getEvents(IContainerModifiedEvent), has_length(1))
+
+        clearEvents()
+        assert_that(c.setitems({u'a': a}), is_(0))
+        assert_that(getEvents(), has_length(0))
+
+    def test_insertitemf(self):
+        class C(_CheckObjectOnSetMixin,
+                LastModifiedBTreeContainer):
+            pass
+        c = C()
+        first = Contained()
+        assert_that(c._insertitemf(u'a', first), is_true())
+        assert_that(c._insertitemf(u'a', Contained()), is_false())
+        assert_that(c[u'a'], is_(same_instance(first)))
+        assert_that(c, has_length(1))
+
+        c = CaseInsensitiveLastModifiedBTreeContainer()
+        assert_that(c._insertitemf(u'Key', first), is_true())
+        assert_that(c._insertitemf(u'KEY', Contained()), is_false())
+        assert_that(c, has_length(1))
+
+        c = EventlessLastModifiedBTreeContainer()
+        assert_that(c._checkSame(u'missing', first), is_false())
+
+        # Without an insert function
+        c = NOOwnershipLastModifiedBTreeContainer()
+        clearEvents()
+        value = object()
+        no_ownership_setitem(c, c._setitemf, u'a', value)
+        no_ownership_setitem(c, c._setitemf, u'b', first)
+        assert_that(getEvents(), has_length(4))
+        no_ownership_setitem(c, c._setitemf, u'b', first)
+        with self.assertRaises(KeyError):
+            no_ownership_setitem(c, c._setitemf, u'b', value)
+        assert_that(getEvents(), has_length(4))
+        assert_that(c, has_length(2))
+        assert_that(c[u'a'], is_not(same_instance(value)))
+
+    def test_insertitemf_overridden_setitemf(self):
+        stored = []
+
+        class Recording(object):
+            def _setitemf(self, key, value):
+                stored.append(key)
+                super(Recording, self)._setitemf(key, value)
+
+        class Eventless(Recording, EventlessLastModifiedBTreeContainer):
+            pass
+
+        class NOOwnership(Recording, NOOwnershipLastModifiedBTreeContainer):
+            pass
+
+        assert_that(EventlessLastModifiedBTreeContainer()._can_insert_once(),
+                    is_true())
+        assert_that(CaseInsensitiveCheckingLastModifiedBTreeContainer()._can_insert_once(),
+                    is_true())
+        for factory in Eventless, NOOwnership:
+            del stored[:]
+            c = factory()
+            assert_that(c._can_insert_once(), is_false())
+            first = Contained()
+            c[u'a'] = first
+            c[u'a'] = first
+            with self.assertRaises(KeyError):
+                c[u'a'] = Contained()
+            assert_that(stored, is_([u'a']))
+            assert_that(c, has_length(1))
+            assert_that(c[u'a'], is_(same_instance(first)))
+
+    def test_remove_contained_declarations(self):
+        # Stored before their class declared IContained, as unpickled
+        c = NOOwnershipLastModifiedBTreeContainer()
+        old, other, located = ContainedLocation(), ContainedLocation(), Location()
+        old.__provides__ = Provides(ContainedLocation, IContained)
+        other.__provides__ = Provides(ContainedLocation, IContained, IOther)
+        # (The class declaration hides it from directlyProvidedBy)
+        assert_that(list(interface.directlyProvidedBy(old)), is_([]))
+        unrelated = ContainedLocation()
+        interface.alsoProvides(unrelated, IOther)
+        c[u'located'] = located
+        assert_that(list(interface.directlyProvidedBy(located)),
+                    is_([IContained]))
+        # The class declaration keeps new objects unchanged
+        new = ContainedLocation()
+        c[u'new'] = new
+        assert_that(new.__dict__, does_not(has_key('__provides__')))
+
+        count = remove_contained_declarations([old, other, located, new,
+                                               unrelated])
+        assert_that(count, is_(2))
+        assert_that(old.__dict__, does_not(has_key('__provides__')))
+        assert_that(list(interface.directlyProvidedBy(other)), is_([IOther]))
+        assert_that(list(interface.directlyProvidedBy(unrelated)),
+                    is_([IOther]))
+        # Without a class declaration, it's kept
+        assert_that(list(interface.directlyProvidedBy(located)),
+                    is_([IContained]))
+
+        # Loaded by another connection, they all still provide it
+        db = DB(None)
+        conn = db.open()
+        conn.root()['objects'] = [old, other, located]
+        transaction.commit()
+        manager = transaction.TransactionManager()
+        other_conn = db.open(manager)
+        try:
+            loaded = other_conn.root()['objects']
+            assert_that(loaded[0], is_not(same_instance(old)))
+            for obj in loaded:
+                assert_that(IContained.providedBy(obj), is_true())
+            assert_that([IOther.providedBy(obj) for obj in loaded],
+                        is_([False, True, False]))
+        finally:
+            manager.abort()
+            other_conn.close()
+            conn.close()
+            db.close()
+
+    def test_aggregate_events(self):
+        c = LastModifiedBTreeContainer()
+        clearEvents()
+        a, b = Contained(), Contained()
+        assert_that(c.setitems({u'b': b, u'a': a}), is_(2))
+        assert_that(a, has_property('__parent__', is_(same_instance(c))))
+        # Per-object events, and one for the container
+        assert_that(getEvents(), has_length(3))
+        event = getEvents(IContainerContentsChangedEvent)[0]
+        assert_that(event, validly_provides(IContainerContentsChangedEvent))
+        assert_that(event.added, is_((u'a', u'b')))
+        assert_that(event.removed, is_(()))
+        with self.assertRaises(KeyError):
+            c.delitems([u'a', u'missing'])
+        clearEvents()
+        c.delitems([u'a'])
+        # The same as del c[u'a']
+        assert_that(getEvents(), has_length(2))
+
+        c.aggregate_events = True
+        clearEvents()
+        c[u'a'] = a
+        c[u'c'] = c2 = Contained()
+        del c[u'a']
+        events = getEvents()
+        assert_that(events, has_length(3))
+        assert_that([e.added for e in events], is_([(u'a',), (u'c',), ()]))
+        assert_that(events[2].removed, is_((u'a',)))
+        assert_that(a, has_property('__parent__', none()))
+        assert_that(c2, has_property('__parent__', is_(same_instance(c))))
+
+        clearEvents()
+        interface.alsoProvides(b, IBroken)
+        c.clear()
+        assert_that(c, has_length(0))
+        assert_that(getEvents(), has_length(1))
+        assert_that(getEvents()[0].removed, is_((u'b', u'c')))
+        assert_that(b, has_property('__parent__', is_(same_instance(c))))
+        c.delitems(())
+        assert_that(getEvents(), has_length(1))
+
+        c = CaseInsensitiveLastModifiedBTreeContainer()
+        c.aggregate_events = True
+        c[u'Key'] = a
+        clearEvents()
+        del c[u'KEY']
+        assert_that(c, has_length(0))
+        assert_that(getEvents()[0].removed, is_((u'KEY',)))
+
+        marker = object()
+        c = NOOwnershipLastModifiedBTreeContainer()
+        c.aggregate_events = True
+        a.__parent__ = marker
+        clearEvents()
+        c[u'a'] = a
+        c.setitems({u'b': Contained()})
+        del c[u'a']
+        c.clear()
+        assert_that([(e.added, e.removed) for e in getEvents()],
+                    is_([((u'a',), ()), ((u'b',), ()),
+                         ((), (u'a',)), ((), (u'b',))]))
+        assert_that(a, has_property('__parent__', is_(marker)))
+
+        c.aggregate_events = False
+        c[u'a'] = a
+        clearEvents()
+        del c[u'a']
+        assert_that(getEvents(IContainerContentsChangedEvent)[0].removed,
+                    is_((u'a',)))
+
     def test_case_sensitive_last_modified_btree_folder(self):
         c = CaseSensitiveLastModifiedBTreeFolder()
         c['key'] = Contained()
@@ -454,3 +748,88 @@ class TestContainers(unittest.TestCase):
         c = c.__of__(alternate_parent)
 
         assert_that(c.get('key').__parent__.__parent__, is_(alternate_parent))
+
+    def test_acquire_iteration(self):
+        class C(Implicit,
+                AcquireObjectsOnReadMixin,
+                LastModifiedBTreeContainer):
+            reuse_acquired_wrappers = True
+
+        class I(Implicit):
+            pass
+
+        class P(Base,
+                Contained):
+            pass
+
+        c_parent = P()
+        c = C()
+        c.__parent__ = c_parent
+        c['a'] = I()
+        c['b'] = I()
+        c['c'] = u'not an acquirer'
+
+        transaction.begin()
+        try:
+            # Reads reuse their wrappers
+            wrapper = c['a']
+            assert_that(c.get('a'), is_(same_instance(wrapper)))
+            assert_that(wrapper.__parent__.__parent__, is_(c_parent))
+            values = list(c.values())
+            assert_that(values[0], is_(same_instance(wrapper)))
+            assert_that(values[1], is_(I))
+            assert_that(values[1].__parent__.__parent__, is_(c_parent))
+            assert_that(values[2], is_(u'not an acquirer'))
+            # Iterating doesn't remember
+            assert_that(c._v_acquired_wrappers[1], has_length(1))
+            assert_that(list(c.values())[1], is_not(same_instance(values[1])))
+
+            items = list(c.items())
+            assert_that(items[0][0], is_('a'))
+            assert_that(items[0][1], is_(same_instance(wrapper)))
+            assert_that([k for k, _ in c.iteritems('a', 'b', excludemin=True)],
+                        is_(['b']))
+            assert_that(list(c.itervalues('a', 'a'))[0], is_(same_instance(wrapper)))
+            assert_that(list(c.iteritems())[1][1].__parent__, is_(same_instance(c)))
+            assert_that(list(c.itervalues()), has_length(3))
+        finally:
+            transaction.abort()
+
+        # A new transaction makes new wrappers
+        transaction.begin()
+        try:
+            assert_that(c['a'], is_not(same_instance(wrapper)))
+        finally:
+            transaction.abort()
+
+        # Acquired through another parent, nothing is reused
+        alternate_parent = P()
+        c = c.__of__(alternate_parent)
+        assert_that(c['a'], is_not(same_instance(c['a'])))
+        value = list(c.values())[0]
+        assert_that(value.__parent__.__parent__, is_(alternate_parent))
+
+        # By default, nothing is remembered
+        c = aq_base(c)
+        c.reuse_acquired_wrappers = False
+        c._v_acquired_wrappers = None
+        assert_that(c['a'], is_not(same_instance(c['a'])))
+        assert_that(list(c.values())[0].__parent__, is_(same_instance(c)))
+        assert_that(c._v_acquired_wrappers, is_(none()))
+
+        # The results are lazy, but sized, indexable and reusable
+        values = c.values()
+        assert_that(values, has_length(3))
+        assert_that(bool(values), is_true())
+        assert_that(values[1].__parent__, is_(same_instance(c)))
+        assert_that(values[-1], is_(u'not an acquirer'))
+        assert_that([v.__parent__ for v in values[:2]], is_([c, c]))
+        assert_that(list(values), has_length(3))
+        assert_that(list(values), has_length(3))
+        items = c.iteritems('a', 'b')
+        assert_that(items, has_length(2))
+        assert_that(items[1][0], is_('b'))
+        assert_that(items[0][1].__parent__, is_(same_instance(c)))
+        assert_that([k for k, _ in items], is_(['a', 'b']))
+        assert_that(bool(C().values()), is_false())
+        assert_that(C().items(), has_length(0))
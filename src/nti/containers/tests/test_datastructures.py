@@ -9,6 +9,7 @@ from __future__ import absolute_import
 # pylint: disable=unsubscriptable-object,attribute-defined-outside-init
 
 from hamcrest import is_
+from hamcrest import none
 from hamcrest import is_in
 from hamcrest import is_not
 from hamcrest import has_key
@@ -30,11 +31,21 @@ from zope.intid.interfaces import IIntIds
 
 import BTrees
 
+import transaction
+
+from persistent.mapping import PersistentMapping
+
+from ZODB import DB
+
 from nti.base.interfaces import ILastModified
 
+from nti.containers.datastructures import ContainerIdInterner
 from nti.containers.datastructures import IntidContainedStorage
 from nti.containers.datastructures import IntidResolvingIterable
 from nti.containers.datastructures import IntidResolvingMappingFacade
+from nti.containers.datastructures import InternedIntidContainedStorage
+from nti.containers.datastructures import PrefetchingIntidResolvingIterable
+from nti.containers.datastructures import sweep_dangling_intids
 from nti.containers.datastructures import _LengthIntidResolvingMappingFacade
 
 from nti.dublincore.datastructures import CreatedModDateTrackingObject
@@ -76,6 +87,61 @@ class TestIntidResolvingIterable(unittest.TestCase):
             pickle.dumps(iterable)
 
 
+class TestPrefetchingIntidResolvingIterable(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_iter(self):
+        db = DB(None)
+        conn = db.open()
+        root = conn.root()
+        utility = TestMappingFacade.MockUtility()
+        utility.data = {}
+        for i in range(7):
+            obj = root[i] = PersistentMapping({'i': i})
+            utility.data[i] = obj
+        transaction.commit()
+        conn.cacheMinimize()
+        prefetched = []
+        conn.prefetch = prefetched.append
+
+        with self.assertRaises(ValueError):
+            PrefetchingIntidResolvingIterable((), readahead=0)
+
+        iterable = PrefetchingIntidResolvingIterable(list(range(10)),
+                                                     allow_missing=True,
+                                                     intids=utility,
+                                                     readahead=3,
+                                                     ghost_consumed=True)
+        assert_that(iterable, has_length(10))
+        seen = []
+        for obj in iterable:
+            # While the first chunk is consumed, the second has
+            # already been prefetched.
+            assert_that(prefetched, has_length(min(len(seen) // 3 + 2, 3)))
+            seen.append(obj['i'])
+            assert_that(obj._p_changed, is_(False))
+        assert_that(seen, is_(list(range(7))))
+        # Everything consumed was ghosted again
+        assert_that([obj._p_changed for obj in utility.data.values()],
+                    is_([None] * 7))
+        assert_that([[x['i'] for x in chunk] for chunk in prefetched],
+                    is_([[0, 1, 2], [3, 4, 5], [6]]))
+
+        # Without ghosting, and with objects that aren't persistent
+        utility.data[7] = object()
+        iterable = PrefetchingIntidResolvingIterable((0, 7), intids=utility)
+        assert_that(list(iterable), has_length(2))
+        assert_that(utility.data[0]._p_changed, is_(False))
+        iterable = PrefetchingIntidResolvingIterable((0, 8), intids=utility)
+        with self.assertRaises(KeyError):
+            list(iterable)
+        assert_that(list(iterable.__iter__(True)), has_length(1))
+        transaction.abort()
+        conn.close()
+        db.close()
+
+
 class TestMappingFacade(unittest.TestCase):
 
     layer = SharedConfiguringTestLayer
@@ -138,7 +204,8 @@ class TestMappingFacade(unittest.TestCase):
         btree['a'] = family64.II.TreeSet()
         facade = _LengthIntidResolvingMappingFacade(btree, intids=self.utility,
                                                     _len=lambda: 1)
-        facade.__parent__ = fudge.Fake().provides('_get_container_mod_time').returns(0)
+        facade.__parent__ = fudge.Fake().provides('_get_container_mod_time').returns(0) \
+                                        .provides('_query_container_length').returns(None)
         facade._wrap('b', 'c')
         assert_that(facade, has_length(1))
 
@@ -255,3 +322,383 @@ class TestIntidContainedStorage(unittest.TestCase):
                     is_(10))
 
         component.getGlobalSiteManager().unregisterUtility(intids, IIntIds)
+
+    def test_bulk(self):
+        storage = self.storage
+        data = self.utility.data
+
+        assert_that(storage.addContainedObjectsToContainer((), 'a'), is_(0))
+        assert_that('a', is_not(is_in(storage)))
+
+        assert_that(storage.addContainedObjectsToContainer([data[1], data[2], data[1]], 'a'),
+                    is_(2))
+        assert_that(storage.addContainedObjectsToContainer([data[2], data[3]], 'a'),
+                    is_(1))
+        assert_that(storage.getContainer('a'), has_length(3))
+        assert_that(storage._get_container_mod_time('a'), is_not(0))
+
+        assert_that(storage.addContainedObjectToContainers(data[1], ('a', 'b', 'c')),
+                    is_(2))
+        assert_that(storage, has_length(3))
+        assert_that(list(storage._containers['b']), is_([1]))
+
+        assert_that(storage.deleteEqualContainedObjectsFromContainer([data[1], data[4]], 'a'),
+                    is_(1))
+        assert_that(list(storage._containers['a']), is_([2, 3]))
+        assert_that(storage.deleteContainedObjectIdsFromContainer([2, 3], 'missing'),
+                    is_(none()))
+        assert_that(storage.deleteEqualContainedObjectsFromContainer([data[2]], 'missing'),
+                    is_(0))
+
+        assert_that(storage.deleteEqualContainedObjectFromContainers(data[1], ('a', 'b', 'c', 'd')),
+                    is_(2))
+        assert_that(storage._containers['b'], has_length(0))
+
+    def test_remove_from_tree_set(self):
+        storage = self.storage
+        storage._inline_container_threshold = 0
+        storage._add_intids_to_container('a', range(1, 21))
+        container_set = storage._containers['a']
+
+        # A few intids are probed for one at a time...
+        class NoMerging(object):
+            II = fudge.Fake('II')  # no intersection
+
+            def __getattr__(self, name):
+                return getattr(family64, name)
+        storage.family = NoMerging()
+        assert_that(storage.deleteContainedObjectIdFromContainer(1, 'a'),
+                    is_(True))
+        assert_that(storage.deleteContainedObjectIdFromContainer(1, 'a'),
+                    is_(False))
+        del storage.family
+        # ...but enough of them are merged
+        assert_that(storage.deleteContainedObjectIdsFromContainer([2, 3, 99], 'a'),
+                    is_(2))
+        assert_that(list(container_set), is_(list(range(4, 21))))
+        assert_that(storage._query_container_length('a')(), is_(17))
+
+        # A container from before the counters is probed
+        del storage._IntidContainedStorage__lengths['a']
+        assert_that(storage.deleteContainedObjectIdsFromContainer(range(4, 10), 'a'),
+                    is_(6))
+        assert_that(storage._query_container_length('a')(), is_(11))
+
+    def test_container_lengths(self):
+        storage = self.storage
+        # Only TreeSets need counters
+        storage._inline_container_threshold = 0
+        data = self.utility.data
+        assert_that(storage._query_container_length('a'), is_(none()))
+
+        storage.addContainedObjectsToContainer([data[1], data[2], data[3]], 'a')
+        storage.addContainedObjectToContainer(data[3], 'a')
+        storage.addContainedObjectToContainers(data[4], ('a', 'b'))
+        storage.deleteEqualContainedObjectFromContainer(data[1], 'a')
+        storage.deleteEqualContainedObjectsFromContainer([data[2], data[5]], 'a')
+        storage.deleteEqualContainedObjectFromContainers(data[4], ('b',))
+
+        container = storage.containers['a']
+        assert_that(container._len, is_not(none()))
+        assert_that(container, has_length(2))
+        assert_that(storage.containers['b'], has_length(0))
+
+        # Containers from before the counters existed fall back
+        # to the set, and get a counter when they are next changed
+        storage._containers['old'] = family64.II.TreeSet([1, 2])
+        assert_that(storage.containers['old']._len, is_(none()))
+        assert_that(storage.containers['old'], has_length(2))
+        storage.addContainedObjectToContainer(data[3], 'old')
+        assert_that(storage._query_container_length('old')(), is_(3))
+
+        storage._containers['older'] = family64.II.TreeSet([1])
+        storage._IntidContainedStorage__lengths['a'].set(100)
+        assert_that(storage.updateContainerLengths(), is_(2))
+        assert_that(storage.updateContainerLengths(), is_(0))
+        assert_that(storage.containers['a'], has_length(2))
+        assert_that(storage.containers['older'], has_length(1))
+
+        storage.popContainer('a')
+        assert_that(storage._query_container_length('a'), is_(none()))
+
+    def test_set_algebra(self):
+        storage = self.storage
+        data = self.utility.data
+        storage.addContainedObjectsToContainer([data[1], data[2], data[3]], 'a')
+        storage.addContainedObjectsToContainer([data[2], data[3], data[4]], 'b')
+        storage.addContainedObjectsToContainer([data[3]], 'c')
+        storage._containers['old'] = family64.II.TreeSet([2, 3, 5])
+
+        def intids(iterable):
+            assert_that(iterable, is_(IntidResolvingIterable))
+            assert_that(iterable.__parent__, is_(storage))
+            return list(iterable.context)
+
+        assert_that(intids(storage.union(('a', 'b', 'missing'))), is_([1, 2, 3, 4]))
+        assert_that(intids(storage.union(())), is_([]))
+
+        assert_that(intids(storage.intersection(('a', 'b'))), is_([2, 3]))
+        assert_that(intids(storage.intersection(('a', 'old'))), is_([2, 3]))
+        assert_that(intids(storage.intersection(('a', 'missing'))), is_([]))
+        assert_that(intids(storage.intersection(())), is_([]))
+        storage.addContainedObjectsToContainer([data[5]], 'd')
+        assert_that(intids(storage.intersection(('d', 'a', 'b'))), is_([]))
+
+        assert_that(intids(storage.difference(('a', 'b'), ('c',))), is_([1, 2, 4]))
+        assert_that(intids(storage.difference(('a', 'b'), ('c',), intersect=True)),
+                    is_([2]))
+        assert_that(intids(storage.difference(('a',), ())), is_([1, 2, 3]))
+
+        # Nothing is mutated
+        assert_that(list(storage._containers['a']), is_([1, 2, 3]))
+
+    def test_containers_modified_since(self):
+        storage = self.storage
+        data = self.utility.data
+        assert_that(storage.containers_modified_since(0), is_([]))
+        assert_that(storage._moddate_index, is_not(none()))
+
+        for i, containerId in enumerate(('a', 'b', 'c', 'd', 'e')):
+            storage.addContainedObjectToContainer(data[i], containerId)
+            storage._set_container_mod_time(containerId, 100.0 + i)
+        # Ties are broken by containerId
+        storage._set_container_mod_time('c', 101.0)
+        storage._set_container_mod_time('c', 101.0)
+
+        def check():
+            assert_that(storage.containers_modified_since(101.0),
+                        is_([('b', 101.0), ('c', 101.0), ('d', 103.0), ('e', 104.0)]))
+            assert_that(storage.containers_modified_since(101.0, limit=1),
+                        is_([('b', 101.0)]))
+            assert_that(storage.containers_modified_since(101.0, limit=2, after='b'),
+                        is_([('c', 101.0), ('d', 103.0)]))
+            assert_that(storage.containers_modified_since(200), is_([]))
+        check()
+
+        # Every entry for a container is replaced, not added
+        assert_that(sum(len(x) for x in storage._moddate_index.values()), is_(5))
+        storage.popContainer('a')
+        assert_that(sum(len(x) for x in storage._moddate_index.values()), is_(4))
+
+        # Without an index, we scan
+        storage._moddate_index = None
+        storage._set_container_mod_time('a', 100.0)
+        check()
+        storage._IntidContainedStorage__moddates.pop('a')
+
+        assert_that(storage.rebuildModificationIndex(), is_(4))
+        check()
+
+    def test_inline_containers(self):
+        storage = self.storage
+        storage._inline_container_threshold = 3
+        data = self.utility.data
+
+        storage.addContainedObjectToContainers(data[1], ('a', 'b'))
+        storage.addContainedObjectsToContainer([data[3], data[2]], 'a')
+        assert_that(storage._containers['a'], is_((1, 2, 3)))
+        assert_that(storage._query_container_length('a'), is_(none()))
+
+        # The facade stays live as the tuple is replaced
+        container = storage.getContainer('a')
+        assert_that(list(container.context), is_([1, 2, 3]))
+        storage.deleteEqualContainedObjectFromContainer(data[2], 'a')
+        assert_that(container, has_length(2))
+        assert_that(storage._containers['a'], is_((1, 3)))
+        assert_that(storage.deleteContainedObjectIdFromContainer(2, 'a'), is_(False))
+        assert_that(storage.deleteContainedObjectIdFromContainer(2, 'missing'), is_(none()))
+
+        assert_that(list(storage.union(('a', 'b')).context), is_([1, 3]))
+        assert_that(list(storage.intersection(('a', 'b')).context), is_([1]))
+        assert_that(storage.updateContainerLengths(), is_(0))
+
+        # Growing past the threshold promotes it
+        assert_that(storage.addContainedObjectsToContainer([data[4], data[5], data[3]], 'a'),
+                    is_(2))
+        assert_that(storage._containers['a'], is_(family64.II.TreeSet))
+        assert_that(storage._query_container_length('a')(), is_(4))
+        assert_that(container, has_length(4))
+        storage.deleteEqualContainedObjectsFromContainer([data[1], data[3], data[4]], 'a')
+        assert_that(storage._containers['a'], is_(family64.II.TreeSet))
+
+        # Popping gives a set either way
+        assert_that(storage.popContainer('a'), is_(family64.II.TreeSet))
+        assert_that(list(storage.popContainer('b')), is_([1]))
+        assert_that(storage, has_length(0))
+
+    def test_reverse_index(self):
+        storage = self.storage
+        data = self.utility.data
+        storage._inline_container_threshold = 1
+        storage.addContainedObjectToContainers(data[1], ('a', 'b', 'c'))
+        storage.addContainedObjectsToContainer([data[2], data[3]], 'a')
+
+        # Without the index, we scan
+        assert_that(storage.containersOf(data[1]), is_(['a', 'b', 'c']))
+        assert_that(storage.enableReverseIndex(), is_(3))
+
+        storage.addContainedObjectsToContainer([data[2]], 'd')
+        assert_that(storage.containersOf(data[2]), is_(['a', 'd']))
+        assert_that(storage.containerIdsForIntid(9), is_([]))
+
+        storage.deleteEqualContainedObjectFromContainer(data[2], 'a')
+        assert_that(storage.containersOf(data[2]), is_(['d']))
+        storage.deleteEqualContainedObjectFromContainer(data[2], 'd')
+        assert_that(storage._reverse_index.get(2), is_(none()))
+
+        storage.popContainer('b')
+        assert_that(storage.containersOf(data[1]), is_(['a', 'c']))
+
+        assert_that(storage.removeIntidEverywhere(1), is_(2))
+        assert_that(storage.containersOf(data[1]), is_([]))
+        assert_that(list(storage._containers['a']), is_([3]))
+        assert_that(list(storage._containers['c']), is_([]))
+        assert_that(storage.removeIntidEverywhere(1), is_(0))
+
+        storage = IntidContainedStorage(family64, reverse_index=True)
+        assert_that(storage._reverse_index, has_length(0))
+
+    def test_dangling_intids(self):
+        storage = self.storage
+        data = self.utility.data
+        storage._inline_container_threshold = 2
+        storage.addContainedObjectsToContainer([data[i] for i in range(5)], 'a')
+        storage.addContainedObjectsToContainer([data[1], data[7]], 'b')
+        storage.addContainedObjectsToContainer([data[8]], 'c')
+        storage.enableReverseIndex()
+
+        # 1, 4 and 7 are gone
+        utility = fudge.Fake().has_attr(refs=family64.IO.BTree())
+        for i in (0, 2, 3, 8):
+            utility.refs[i] = data[i]
+        utility.provides('getObject').calls(utility.refs.__getitem__)
+        facade = IntidResolvingMappingFacade(storage._containers,
+                                             allow_missing=True,
+                                             intids=utility)
+        assert_that(list(facade['a']), has_length(3))
+        assert_that(facade['b'], has_property('missing_count', 0))
+        b = facade['b']
+        # Membership tests don't count as misses
+        assert_that(data[1], is_not(is_in(b)))
+        assert_that(b, has_property('missing_count', 0))
+        a = facade['a']
+        assert_that(data[2], is_in(a))
+        assert_that(a, has_property('missing_count', 0))
+        assert_that(list(b), is_([]))
+        assert_that(b, has_property('missing_count', 2))
+        assert_that(facade, has_property('missing_count', 4))
+
+        assert_that(storage.removeDanglingIntids(utility, limit=1),
+                    is_((2, 'a')))
+        assert_that(storage.removeDanglingIntids(utility, start='a'),
+                    is_((2, 'c')))
+        assert_that(storage.removeDanglingIntids(utility, start='c'),
+                    is_((0, None)))
+        assert_that(list(storage._containers['a']), is_([0, 2, 3]))
+        assert_that(storage.getContainer('a'), has_length(3))
+        assert_that(storage._containers['b'], is_(()))
+        assert_that(storage.containerIdsForIntid(1), is_([]))
+
+        storage.addContainedObjectsToContainer([data[4], data[9]], 'b')
+        manager = fudge.Fake().provides('commit').times_called(2)
+        manager.provides('get').returns(fudge.Fake().is_a_stub())
+        component.getGlobalSiteManager().registerUtility(utility, IIntIds)
+        try:
+            assert_that(sweep_dangling_intids(storage, batch_size=2,
+                                              transaction_manager=manager),
+                        is_(2))
+        finally:
+            component.getGlobalSiteManager().unregisterUtility(utility, IIntIds)
+        fudge.verify()
+        assert_that(sweep_dangling_intids(storage, utility), is_(0))
+
+
+class TestInternedIntidContainedStorage(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    class FixedUtilityInternedStorage(InternedIntidContainedStorage):
+
+        def _get_intid_for_object_from_utility(self, contained):
+            return contained
+
+    def test_interner(self):
+        interner = ContainerIdInterner(family64)
+        assert_that(interner.queryId(u'a'), is_(none()))
+        uid = interner.getId(u'a')
+        assert_that(interner.getId(u'a'), is_(uid))
+        assert_that(interner.queryId(u'a'), is_(uid))
+        assert_that(interner.getContainerId(uid), is_(u'a'))
+        assert_that(interner, has_length(1))
+        repr(interner)
+
+        # Allocation is sequential, skipping used ids
+        interner._v_nextid = uid
+        assert_that(interner.getId(u'b'), is_not(uid))
+        interner._v_nextid = family64.maxint + 1
+        interner.getId(u'c')
+        assert_that(interner, has_length(3))
+
+    def test_storage(self):
+        interner = ContainerIdInterner(family64)
+        storage = self.FixedUtilityInternedStorage(family64, reverse_index=True,
+                                                   interner=interner)
+        other = self.FixedUtilityInternedStorage(family64, interner=interner)
+        storage._inline_container_threshold = 2
+
+        storage.addContainedObjectToContainer(1, u'tag:a')
+        storage.addContainedObjectsToContainer([1, 2, 3], u'tag:b')
+        storage.addContainedObjectToContainers(4, (u'tag:a', u'tag:c'))
+        other.addContainedObjectToContainer(1, u'tag:c')
+        assert_that(interner, has_length(3))
+        assert_that(list(storage._containers.keys()),
+                    is_(sorted(interner.queryId(x) for x in (u'tag:a', u'tag:b', u'tag:c'))))
+
+        assert_that(sorted(storage), is_([u'tag:a', u'tag:b', u'tag:c']))
+        assert_that(sorted(storage.keys()), is_([u'tag:a', u'tag:b', u'tag:c']))
+        assert_that(storage, has_length(3))
+        assert_that(u'tag:a', is_in(storage))
+        assert_that(u'tag:x', is_not(is_in(storage)))
+
+        assert_that(storage._container_map(), has_length(3))
+        containers = storage.containers
+        assert_that(containers, has_length(3))
+        assert_that(sorted(containers), is_([u'tag:a', u'tag:b', u'tag:c']))
+        assert_that(sorted(containers.keys()), is_([u'tag:a', u'tag:b', u'tag:c']))
+        assert_that(u'tag:b', is_in(containers))
+        assert_that(list(containers[u'tag:a'].context), is_([1, 4]))
+        assert_that(containers[u'tag:b'], has_length(3))
+        assert_that(containers[u'tag:b'].lastModified, is_not(0))
+        assert_that(storage.getContainer(u'tag:x'), is_(none()))
+        assert_that(storage._get_container_mod_time(u'tag:x'), is_(0))
+        assert_that(storage._query_container_length(u'tag:x'), is_(none()))
+        assert_that(sorted(k for k, _ in storage.items()),
+                    is_([u'tag:a', u'tag:b', u'tag:c']))
+
+        assert_that(sorted(storage.containerIdsForIntid(4)), is_([u'tag:a', u'tag:c']))
+        assert_that(list(storage.intersection((u'tag:a', u'tag:b')).context), is_([1]))
+        assert_that(list(storage.union((u'tag:a', u'tag:x')).context), is_([1, 4]))
+
+        modified = storage.containers_modified_since(0)
+        assert_that(sorted(x for x, _ in modified), is_([u'tag:a', u'tag:b', u'tag:c']))
+        assert_that(storage.containers_modified_since(modified[0][1], after=modified[0][0]),
+                    is_(modified[1:]))
+        assert_that(storage.containers_modified_since(0, after=u'tag:x'), is_(modified))
+
+        assert_that(storage.deleteContainedObjectIdFromContainer(4, u'tag:a'), is_(True))
+        assert_that(storage.deleteContainedObjectIdFromContainer(4, u'tag:x'), is_(none()))
+        assert_that(storage.deleteEqualContainedObjectsFromContainer([2, 3], u'tag:b'),
+                    is_(2))
+        assert_that(storage.deleteEqualContainedObjectFromContainers(1, (u'tag:a', u'tag:x')),
+                    is_(1))
+        assert_that(storage.removeIntidEverywhere(4), is_(1))
+
+        assert_that(list(storage.popContainer(u'tag:b')), is_([1]))
+        with self.assertRaises(KeyError):
+            storage.popContainer(u'tag:x')
+        assert_that(storage.popContainer(u'tag:x', None), is_(none()))
+        assert_that(storage, has_length(2))
+
+        # Each storage gets its own interner by default
+        assert_that(InternedIntidContainedStorage(family64).interner,
+                    is_not(interner))
@@ -19,8 +19,24 @@ from hamcrest import greater_than
 from nti.testing.matchers import is_true
 from nti.testing.matchers import is_false
 
+import os
+import sys
+import fudge
+import random
+import shutil
+import tempfile
 import unittest
 
+from decimal import Decimal
+
+import BTrees
+
+import transaction
+
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
 from zope.container import contained
 
 from nti.containers import dicts
@@ -127,6 +143,447 @@ class TestDict(unittest.TestCase):
         # coverage
         c.updateLastModIfGreater(c.lastModified + 100)
 
+    def test_bulk_update(self):
+        c = dicts.Dict({'a': 1})
+        c.update([('b', 2), ('a', 3)], c=4)
+        assert_that(c, has_length(3))
+        assert_that(list(c.items()), is_([('a', 3), ('b', 2), ('c', 4)]))
+
+        # Sorted input is used as-is
+        other = dicts.Dict(d=5, a=6)
+        c.update(other)
+        c.update(other._data)
+        c.update({})
+        assert_that(c, has_length(4))
+        assert_that(c['a'], is_(6))
+
+        # Mappings that aren't BTrees go through their keys
+        c.update(dicts.OrderedDict([('e', 7)]))
+        assert_that(c, has_length(5))
+
+        # Small updates of a big dict look up each key
+        big = dicts.Dict([(str(i), i) for i in range(100)])
+        module = sys.modules[type(big._data).__module__]
+        intersection = module.intersection
+        module.intersection = None
+        try:
+            big.update({'1': 'one', 'new': 'new'})
+        finally:
+            module.intersection = intersection
+        assert_that(big, has_length(101))
+        assert_that(big['1'], is_('one'))
+        assert_that(big['new'], is_('new'))
+
+        case = dicts.CaseInsensitiveLastModifiedDict(A=1)
+        assert_that(case._can_update_in_bulk(), is_false())
+        c.update(case)
+        assert_that(c['A'], is_(1))
+        assert_that(c, has_length(6))
+
+        m = dicts.LastModifiedDict()
+        m.update({'a': 1, 'b': 2})
+        assert_that(m, has_length(2))
+        assert_that(m.lastModified, is_(greater_than(0)))
+        m.lastModified = 0
+        m.update(())
+        assert_that(m.lastModified, is_(0))
+
+    def test_views(self):
+        c = dicts.Dict(a=1, b=2, c=3, d=4)
+        keys, values, items = c.keys(), c.values(), c.items()
+        assert_that(keys, is_(dicts.DictKeysView))
+        assert_that(keys, has_length(4))
+        assert_that('a', is_in(keys))
+        assert_that('z', is_not(is_in(keys)))
+        assert_that(('b', 2), is_in(items))
+        assert_that(('b', 3), is_not(is_in(items)))
+        assert_that(3, is_in(values))
+
+        assert_that(keys[0], is_('a'))
+        assert_that(keys[-1], is_('d'))
+        assert_that(values[1:3], is_([2, 3]))
+        assert_that(items[::-2], is_([('d', 4), ('b', 2)]))
+        assert_that(list(reversed(keys)), is_(['d', 'c', 'b', 'a']))
+        assert_that(list(values.range('b', 'c')), is_([2, 3]))
+        assert_that(list(items.range('b', excludemin=True)),
+                    is_([('c', 3), ('d', 4)]))
+        assert_that(list(values), is_([1, 2, 3, 4]))
+        assert_that(repr(keys), is_('DictKeysView(%r)' % (c,)))
+
+        # Views are live
+        c['e'] = 5
+        assert_that(keys, has_length(5))
+        assert_that(keys & {'a', 'e', 'z'}, is_({'a', 'e'}))
+
+        with self.assertRaises(NotImplementedError):
+            dicts._DictViewMixin()._value('a')
+
+        c.legacy_list_views = True
+        assert_that(c.keys(), is_(['a', 'b', 'c', 'd', 'e']))
+        assert_that(c.values(), is_([1, 2, 3, 4, 5]))
+        assert_that(c.items()[0], is_(('a', 1)))
+
+        o = dicts.OrderedDict([('b', 1), ('a', 2), ('c', 3)])
+        assert_that(o.keys(), is_(dicts.OrderedDictKeysView))
+        assert_that(list(o.keys()), is_(['b', 'a', 'c']))
+        assert_that(o.values()[0], is_(1))
+        assert_that(list(reversed(o.items())),
+                    is_([('c', 3), ('a', 2), ('b', 1)]))
+        with self.assertRaises(TypeError):
+            o.keys().range('a')
+        o.legacy_list_views = True
+        assert_that(o.items(), is_([('b', 1), ('a', 2), ('c', 3)]))
+
+    def test_copy(self):
+        c = dicts.LastModifiedDict(a=1, b=2)
+        c.lastModified = 42
+        cp = c.copy()
+        assert_that(cp, is_(dicts.LastModifiedDict))
+        assert_that(cp, has_length(2))
+        assert_that(cp.createdTime, is_(c.createdTime))
+        assert_that(cp.lastModified, is_(greater_than(42)))
+        assert_that(cp._data, is_not(c._data))
+        assert_that(cp._len, is_not(c._len))
+
+        # The copy is independent
+        cp['c'] = 3
+        cp.lastModified = 50
+        assert_that(c, has_length(2))
+        assert_that('c', is_not(is_in(c)))
+        assert_that(c.lastModified, is_(42))
+
+        cp = dicts.LastModifiedDict().copy()
+        assert_that(cp.lastModified, is_(0))
+
+        o = dicts.OrderedDict([('b', 1), ('a', 2)])
+        cp = o.copy()
+        cp['c'] = 3
+        assert_that(list(cp), is_(['b', 'a', 'c']))
+        assert_that(list(o), is_(['b', 'a']))
+
+    def test_btree_type(self):
+        c = dicts.Dict({3: 'c', 1: 'a'}, btree_type=BTrees.family64.IO)
+        assert_that(c._data, is_(BTrees.LOBTree.LOBTree))
+        c.update({2: 'b', 3: 'C'})
+        assert_that(c, has_length(3))
+        assert_that(list(c.items()), is_([(1, 'a'), (2, 'b'), (3, 'C')]))
+        with self.assertRaises(TypeError):
+            c['key'] = 'value'
+        cp = c.copy()
+        assert_that(cp._data, is_(BTrees.LOBTree.LOBTree))
+        assert_that(cp, has_length(3))
+
+        m = dicts.LastModifiedDict(btree_type=BTrees.OIBTree.OIBTree, a=1)
+        assert_that(m._data, is_(BTrees.OIBTree.OIBTree))
+        assert_that(m['a'], is_(1))
+        assert_that(m.lastModified, is_(greater_than(0)))
+
+        class IntDict(dicts.Dict):
+            btree_type = BTrees.family64.II
+        assert_that(IntDict()._data, is_(BTrees.LLBTree.LLBTree))
+
+    def test_batched_last_modified(self):
+        c = dicts.LastModifiedDict()
+        with c.batched():
+            c['a'] = 1
+            c['b'] = 2
+            del c['a']
+            assert_that(c.lastModified, is_(0))
+            with c.batched():
+                c.pop('b')
+            assert_that(c.lastModified, is_(0))
+        assert_that(c.lastModified, is_(greater_than(0)))
+
+        # An explicit time is kept
+        future = c.lastModified + 1000
+        with c.batched():
+            c.updateLastMod(future - 1)
+            c.updateLastMod(future)
+            c.updateLastMod(future - 2)
+            c['a'] = 1
+        assert_that(c.lastModified, is_(future))
+
+        # Nothing changed, nothing updated
+        c.lastModified = 0
+        with c.batched():
+            c.pop('missing', None)
+        assert_that(c.lastModified, is_(0))
+
+    def test_batch_until_commit(self):
+        c = dicts.LastModifiedDict()
+        transaction.begin()
+        c.batchUntilCommit()
+        c.batchUntilCommit()
+        c['a'] = 1
+        with c.batched():
+            c['b'] = 2
+        assert_that(c.lastModified, is_(0))
+        transaction.commit()
+        assert_that(c.lastModified, is_(greater_than(0)))
+
+        # An aborted transaction leaves nothing behind
+        c.lastModified = 0
+        c.batchUntilCommit()
+        c['c'] = 3
+        transaction.abort()
+        assert_that(c.lastModified, is_(0))
+        c['d'] = 4
+        assert_that(c.lastModified, is_(greater_than(0)))
+
+        # Even if the aborted transaction is still around
+        c.lastModified = 0
+        c.batchUntilCommit()
+        aborted = transaction.get()
+        transaction.abort()
+        c['e'] = 5
+        assert_that(c.lastModified, is_(greater_than(0)))
+        del aborted
+
+        # Using a stored object's own transaction manager
+        db = DB(None)
+        manager = transaction.TransactionManager()
+        conn = db.open(manager)
+        conn.root()['c'] = c
+        manager.commit()
+        c.lastModified = 0
+        c.batchUntilCommit()
+        c['e'] = 5
+        assert_that(c.lastModified, is_(0))
+        manager.commit()
+        assert_that(c.lastModified, is_(greater_than(0)))
+        conn.close()
+        db.close()
+
+    def test_batch_survives_ghosting(self):
+        db = DB(None)
+        manager = transaction.TransactionManager()
+        conn = db.open(manager)
+        c = conn.root()['c'] = dicts.LastModifiedDict()
+        manager.commit()
+
+        def ghost():
+            # A savepoint lets the cache ghost the modified dict
+            manager.savepoint()
+            conn.cacheMinimize()
+            assert_that(c._p_status, is_('ghost'))
+
+        with c.batched():
+            c['a'] = 1
+            ghost()
+            c['b'] = 2
+            assert_that(c.lastModified, is_(0))
+        assert_that(c.lastModified, is_(greater_than(0)))
+        manager.commit()
+
+        c.lastModified = 0
+        c.batchUntilCommit()
+        c['c'] = 3
+        ghost()
+        c['d'] = 4
+        assert_that(c.lastModified, is_(0))
+        manager.commit()
+        assert_that(c.lastModified, is_(greater_than(0)))
+
+        # Finishing without a batch does nothing
+        c._finish_lastModBatch(None)
+        conn.close()
+        db.close()
+
+    def test_bounded_dict(self):
+        d = dicts.BoundedDict(maxsize=3)
+        # Evict exactly the oldest
+        d._eviction_window = 1
+        for k in 'abcde':
+            d[k] = k
+        assert_that(d, has_length(3))
+        assert_that(sorted(d), is_(['c', 'd', 'e']))
+        assert_that(d._stamps, has_length(3))
+        # Rewriting refreshes
+        d['c'] = 'C'
+        d['f'] = 'f'
+        assert_that(sorted(d), is_(['c', 'e', 'f']))
+        # Reading doesn't, by default
+        assert_that(d['e'], is_('e'))
+        d['g'] = 'g'
+        assert_that(sorted(d), is_(['c', 'f', 'g']))
+
+        assert_that(d.popitem(), is_(('c', 'C')))
+        assert_that(d.pop('f'), is_('f'))
+        assert_that(d.pop('f', None), is_(none()))
+        assert_that(list(d._key_stamps), is_(['g']))
+
+        cp = d.copy()
+        d.clear()
+        assert_that(d._stamps, has_length(0))
+        with self.assertRaises(KeyError):
+            d.popitem()
+        assert_that(list(cp.items()), is_([('g', 'g')]))
+        assert_that(cp._stamps, is_not(d._stamps))
+
+        # Lazy eviction after lowering the size
+        d = dicts.BoundedDict(((str(i), i) for i in range(10)), maxsize=20)
+        d.maxsize = 4
+        d._eviction_window = 1
+        d['x'] = 1
+        assert_that(d, has_length(9))
+        assert_that(d.evict(), is_(5))
+        assert_that(d.evict(), is_(0))
+        assert_that(sorted(d), is_(['7', '8', '9', 'x']))
+
+        d = dicts.BoundedDict(maxsize=2, lru=True)
+        d._eviction_window = 1
+        d['a'] = d['b'] = 1
+        assert_that(d.get('a'), is_(1))
+        assert_that(d.get('z'), is_(none()))
+        d['c'] = 1
+        assert_that(sorted(d), is_(['a', 'c']))
+
+    def test_bounded_dict_window(self):
+        d = dicts.BoundedDict(((str(i), i) for i in range(10)), maxsize=10)
+        for _ in range(20):
+            d['x'] = 1
+            assert_that(d, has_length(10))
+            # Something old went
+            assert_that('x', is_in(d))
+            del d['x']
+            d['y'] = 1
+
+        d = dicts.BoundedDict(maxsize=0)
+        d['x'] = 1
+        assert_that(d, has_length(0))
+
+    @fudge.patch('nti.containers.dicts.time')
+    def test_bounded_dict_stamps(self, fake_time):
+        fake_time.provides('time').returns(1.0)
+        d = dicts.BoundedDict()
+        base = 1000000 << 10
+        # Every random choice for this time is taken
+        for stamp in range(base, base + 1024):
+            d._stamps[stamp] = 'x'
+        assert_that(d._new_stamp(), is_(base + 1024))
+
+    def test_sharded_dict(self):
+        d = dicts.ShardedDict(shard_count=4)
+        d.update((str(i), i) for i in range(20))
+        d[u'5'] = 'FIVE'
+        d['x'] = 'x'
+        assert_that(d._shards, has_length(4))
+        assert_that(d, has_length(21))
+        assert_that([len(shard) for shard in d._shards],
+                    is_([length() for length in d._lengths]))
+        assert_that(d['5'], is_('FIVE'))
+        assert_that(d.get('x'), is_('x'))
+        assert_that(d.get('missing', 1), is_(1))
+        assert_that('x', is_in(d))
+        assert_that(d.has_key('x'), is_true())
+        assert_that(d.setdefault('1', 42), is_(1))
+        assert_that(d.setdefault('new', 42), is_(42))
+        assert_that(d, has_length(22))
+
+        assert_that(d.pop('x'), is_('x'))
+        d['5'] = 5
+        del d['new']
+        assert_that(d.pop('missing', None), is_(none()))
+        with self.assertRaises(KeyError):
+            d.pop('missing')
+        assert_that(d, has_length(20))
+
+        # Shard by shard, or merged
+        assert_that(sorted(d), is_(sorted(str(i) for i in range(20))))
+        assert_that(list(d), is_not(sorted(d)))
+        assert_that(dict(d.iteritems()), is_({str(i): i for i in range(20)}))
+        d.ordered = True
+        assert_that(list(d.keys()), is_(sorted(str(i) for i in range(20))))
+        assert_that(list(d.values())[:3], is_([0, 1, 10]))
+        assert_that(d.items()[-1], is_(('9', 9)))
+        assert_that(list(d.keys().range('17', '3')), is_(['17', '18', '19', '2', '3']))
+
+        cp = d.copy()
+        cp['c'] = 1
+        assert_that(cp, has_length(21))
+        assert_that(d, has_length(20))
+
+        key, _ = d.popitem()
+        assert_that(key, is_not(is_in(d)))
+        d.clear()
+        assert_that(d, has_length(0))
+        with self.assertRaises(KeyError):
+            d.popitem()
+
+        d = dicts.ShardedDict({17: 'a'}, btree_type=BTrees.family64.IO, ordered=True)
+        assert_that(d._shards[0], is_(BTrees.LOBTree.LOBTree))
+        assert_that(d._shards, has_length(16))
+        # Integers shard by value
+        assert_that(list(d._shards[1]), is_([17]))
+        assert_that(dicts._stable_hash(b'x'), is_(dicts._stable_hash(u'x')))
+
+        # Keys that compare equal are found in the same shard
+        d = dicts.ShardedDict()
+        d[1] = 'one'
+        d[2.0] = 'two'
+        d[2.5] = 'two and a half'
+        assert_that(1.0, is_in(d))
+        assert_that(Decimal(1), is_in(d))
+        assert_that(d[2], is_('two'))
+        assert_that(d[Decimal('2.5')], is_('two and a half'))
+        assert_that(float('inf'), is_not(is_in(d)))
+        assert_that(float('nan'), is_not(is_in(d)))
+        assert_that(dicts._stable_hash(1j), is_(dicts._stable_hash(u'1j')))
+
+    def test_counter_dict(self):
+        d = dicts.CounterDict({'a': 2})
+        assert_that(d.increment('a'), is_(3))
+        assert_that(d.increment('b', 5), is_(5))
+        d.increment_many({'a': 1, 'c': -1})
+        d.increment_many([('c', 2)])
+        assert_that(dict(d.items()), is_({'a': 4, 'b': 5, 'c': 1}))
+        assert_that(list(d.values()), is_([4, 5, 1]))
+        assert_that(d['b'], is_(5))
+        assert_that(d.get('missing'), is_(0))
+        assert_that(d.get('a'), is_(4))
+        assert_that(d.setdefault('a'), is_(4))
+        assert_that(d.setdefault('d', 7), is_(7))
+        d['d'] = 10
+        assert_that(d['d'], is_(10))
+        assert_that(d, has_length(4))
+
+        cp = d.copy()
+        cp.increment('a')
+        assert_that(d['a'], is_(4))
+        assert_that(cp['a'], is_(5))
+
+        assert_that(d.pop('d'), is_(10))
+        assert_that(d.pop('d', None), is_(none()))
+        with self.assertRaises(KeyError):
+            d.pop('d')
+        assert_that(d.popitem(), is_(('a', 4)))
+        assert_that(d, has_length(2))
+
+    def test_counter_dict_concurrent(self):
+        tmp = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmp, 'Data.fs')))
+        try:
+            managers = [transaction.TransactionManager() for _ in range(3)]
+            conns = [db.open(manager) for manager in managers]
+            conns[0].root()['d'] = dicts.CounterDict({'a': 1, 'b': 1})
+            managers[0].commit()
+            for conn in conns[1:]:
+                conn.sync()
+            # The same key, and a neighbouring one
+            conns[0].root()['d'].increment('a')
+            conns[1].root()['d'].increment_many({'a': 2, 'b': 1})
+            conns[2].root()['d'].increment('b', 3)
+            for manager in managers:
+                manager.commit()
+            conns[0].sync()
+            d = conns[0].root()['d']
+            assert_that(dict(d.items()), is_({'a': 4, 'b': 5}))
+            for conn in conns:
+                conn.close()
+        finally:
+            db.close()
+            shutil.rmtree(tmp)
+
     def test_case_insensitive_dict(self):
         c = dicts.CaseInsensitiveLastModifiedDict()
         assert_that(c.get(None), is_(none()))
@@ -162,7 +619,10 @@ class TestDict(unittest.TestCase):
         del c['upper']
 
     def test_minimal_list(self):
-        d = dicts.MinimalList()
+        self._check_list(dicts.MinimalList)
+
+    def _check_list(self, factory):
+        d = factory()
         d.append('ichigo')
         d.append('aizen')
         assert_that(d, has_length(2))
@@ -187,8 +647,128 @@ class TestDict(unittest.TestCase):
         d.extend(('ichigo', 'urahara'))
         assert_that(d, has_length(2))
 
+    def test_indexed_list(self):
+        self._check_list(dicts.IndexedList)
+        assert_that(dicts.list_type(), is_(dicts.MinimalList))
+
+        class Small(dicts.IndexedList):
+            _max_leaf_size = 3
+            _max_branch_size = 3
+
+        rnd = random.Random(42)
+        expected = list(range(50))
+        d = Small(expected)
+        assert_that(d._root, is_(dicts._IndexedListBranch))
+        for _ in range(300):
+            op = rnd.choice(('insert', 'insert', 'append', 'pull', 'set'))
+            if op == 'insert':
+                index = rnd.randint(-len(expected) - 2, len(expected) + 2)
+                expected.insert(index, op)
+                d.insert(index, op)
+            elif op == 'append':
+                expected.append(op)
+                d.append(op)
+            elif op == 'set' and expected:
+                index = rnd.randrange(len(expected))
+                expected[index] = d[index] = index
+            elif expected:
+                index = rnd.randrange(-len(expected), len(expected))
+                assert_that(d.pull(index), is_(expected.pop(index)))
+            assert_that(d, has_length(len(expected)))
+        assert_that(list(d), is_(expected))
+        assert_that(d[-1], is_(expected[-1]))
+        assert_that(d[5:17], is_(expected[5:17]))
+        assert_that(d[::-3], is_(expected[::-3]))
+        assert_that(d[len(d):], is_([]))
+        assert_that(repr(d), is_('<Small %r>' % (expected,)))
+
+        for bad in (len(d), -len(d) - 1):
+            with self.assertRaises(IndexError):
+                d[bad]
+            with self.assertRaises(IndexError):
+                d.pull(bad)
+
+        while d:
+            del d[0]
+        assert_that(d._root, is_(dicts._IndexedListLeaf))
+        assert_that(list(d), is_([]))
+        d.extend(range(20))
+        d.extend(range(20, 25))
+        assert_that(list(d), is_(list(range(25))))
+        assert_that(d.index(24), is_(24))
+        with self.assertRaises(IndexError):
+            d._root.locate(100)
+
+        # Pulling from the only child of a branch
+        d.replace(range(4))
+        d.pull(3)
+        d.pull(0)
+        assert_that(list(d), is_([1, 2]))
+        assert_that(d._root, is_(dicts._IndexedListLeaf))
+
+    def test_migrate_list(self):
+        old = dicts.MinimalList()
+        old.extend(('a', 'b'))
+        new = dicts.migrate_list(old)
+        assert_that(new, is_(dicts.IndexedList))
+        assert_that(list(new), is_(['a', 'b']))
+        assert_that(dicts.migrate_list(new), is_(new))
+
+        d = dicts.OrderedDict([('b', 1), ('a', 2)])
+        assert_that(d._order, is_(dicts.MinimalList))
+        assert_that(d.keys()[1], is_('a'))
+        assert_that(d.migrateOrder(), is_true())
+        assert_that(d.migrateOrder(), is_false())
+        assert_that(d._order, is_(dicts.IndexedList))
+        assert_that(list(d.keys()), is_(['b', 'a']))
+        assert_that(d.values()[1], is_(2))
+        assert_that(d.copy()._order, is_(dicts.IndexedList))
+
     def test_ordered_dict(self):
-        d = dicts.OrderedDict()
+        self._check_ordered_dict(dicts.OrderedDict)
+
+        class Indexed(dicts.OrderedDict):
+            indexed_order = True
+        self._check_ordered_dict(Indexed)
+        assert_that(Indexed()._order, is_(dicts.IndexedList))
+
+    def test_ordered_dict_concurrent(self):
+        def indexed(items):
+            d = dicts.OrderedDict(items)
+            d.migrateOrder()
+            return d
+
+        tmp = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmp, 'Data.fs')))
+        try:
+            for factory, conflicts in ((dicts.OrderedDict, False),
+                                       (indexed, True)):
+                managers = [transaction.TransactionManager() for _ in range(2)]
+                conns = [db.open(manager) for manager in managers]
+                conns[0].root()['d'] = factory([('a', 1)])
+                managers[0].commit()
+                conns[1].sync()
+                conns[0].root()['d']['b'] = 2
+                conns[1].root()['d']['c'] = 3
+                managers[0].commit()
+                if conflicts:
+                    with self.assertRaises(ConflictError):
+                        managers[1].commit()
+                    managers[1].abort()
+                else:
+                    # The MinimalList merges the appends
+                    managers[1].commit()
+                    conns[0].sync()
+                    assert_that(sorted(conns[0].root()['d']),
+                                is_(['a', 'b', 'c']))
+                for conn in conns:
+                    conn.close()
+        finally:
+            db.close()
+            shutil.rmtree(tmp)
+
+    def _check_ordered_dict(self, factory):
+        d = factory()
         d['foo'] = 'bar'
         assert_that(d, has_length(1))
         d['bar'] = 'baz'
@@ -277,7 +857,7 @@ class TestDict(unittest.TestCase):
 
         assert_that(c.get('nonexistent', 'default'), is_('default'))
 
-        class N(dicts.OrderedDict):
+        class N(factory):
             pass
         n = N()
         n['k'] = contained.Contained()
@@ -286,3 +866,47 @@ class TestDict(unittest.TestCase):
         assert_that(c, is_(N))
         assert_that(c, has_length(1))
         assert_that(n, has_length(1))
+
+    def test_btree_ordered_dict(self):
+        self._check_ordered_dict(dicts.BTreeOrderedDict)
+
+        d = dicts.BTreeOrderedDict([('a', 1), ('b', 2), ('c', 3)])
+        assert_that(d.keys(), is_(dicts.BTreeOrderedDictKeysView))
+        assert_that(d.keys()[-1], is_('c'))
+        assert_that(d.items()[1], is_(('b', 2)))
+        assert_that(list(d.itervalues()), is_([1, 2, 3]))
+
+        d.move_to_end('a')
+        assert_that(list(d), is_(['b', 'c', 'a']))
+        d.move_to_end('a', last=False)
+        assert_that(list(d), is_(['a', 'b', 'c']))
+        with self.assertRaises(KeyError):
+            d.move_to_end('z')
+
+        d.insert_before('c', 'x', 24)
+        assert_that(list(d), is_(['a', 'b', 'x', 'c']))
+        d.insert_before('a', 'y', 25)
+        assert_that(list(d), is_(['y', 'a', 'b', 'x', 'c']))
+        # Moves an existing key
+        d.insert_before('y', 'c', 3)
+        assert_that(list(d), is_(['c', 'y', 'a', 'b', 'x']))
+        d.insert_before('c', 'c', 4)
+        assert_that(d['c'], is_(4))
+        assert_that(d, has_length(5))
+        with self.assertRaises(KeyError):
+            d.insert_before('z', 'q', 1)
+
+        # Run out of room between two positions
+        d._position_gap = 4
+        d.updateOrder(['a', 'b', 'c', 'x', 'y'])
+        for i in '01234':
+            d.insert_before('b', i, i)
+        assert_that(list(d), is_(['a', '0', '1', '2', '3', '4', 'b', 'c', 'x', 'y']))
+        assert_that(d._positions, has_length(10))
+
+        assert_that(d.popitem(last=True), is_(('y', 25)))
+        assert_that(d.popitem(), is_(('a', 1)))
+        d.clear()
+        with self.assertRaises(KeyError):
+            d.popitem()
+        assert_that(d._order, has_length(0))